@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import logging
+import platform
+import datetime
+import tempfile
+import subprocess
+import re
+import xxhash
+import configupdater
+import numpy as np
+
+from PIL import Image
+from argparse import ArgumentParser
+from pixiv_tag_matcher import TagMatcher
+from pixiv_database import initDB, load_picture_index, filter_picture_ids
+
+
+def populate_pictures(db, size: int, rng, tag_vocab: int = 0, tags_per_image: float = 0, tag_distribution: str = "zipf", chunk_size: int = 100000):
+    # fill the pictures table with synthetic rows (random ids, r18/orientation/ai_type distributions close to a real crawl)
+    # each picture gets a Poisson distributed number of tags drawn from tag_vocab tags, either uniformly or following Zipf's law like real tags
+    cursor = db.cursor()
+    picture_ids = rng.choice(2 ** 32, size=size, replace=False)
+    with db:
+        cursor.executemany("INSERT INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url) VALUES (?, ?, ?, ?, ?, 0, 1, ?, ?, ?, ?)", ((
+            int(picture_id), i, int(rng.integers(1, size // 10 + 2)), "author", "title", int(rng.choice(3, p=[0.3, 0.6, 0.1])), int(rng.random() < 0.3), int(rng.choice(3, p=[0.8, 0.1, 0.1])), "https://i.pximg.net/" + str(i) + ".jpg") for i, picture_id in enumerate(picture_ids)))
+    if tag_vocab and tags_per_image:
+        # tag_id is the hash of the tag name, as for crawled tags
+        tag_names = ["tag{}".format(i) for i in range(tag_vocab)]
+        tag_ids = np.array([xxhash.xxh32_intdigest(name)
+                           for name in tag_names], dtype=np.int64)
+        weights = 1 / np.arange(1, tag_vocab + 1) if tag_distribution == "zipf" else np.ones(tag_vocab)
+        weights /= weights.sum()
+        with db:
+            cursor.executemany("INSERT OR IGNORE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)", ((
+                int(tag_id), name, name.upper()) for tag_id, name in zip(tag_ids, tag_names)))
+        # tags are drawn chunk by chunk, so that memory stays bounded for millions of pictures
+        for start in range(0, size, chunk_size):
+            chunk = picture_ids[start:start + chunk_size]
+            counts = np.minimum(rng.poisson(tags_per_image, len(chunk)), tag_vocab)
+            drawn = tag_ids[rng.choice(tag_vocab, size=int(counts.sum()), p=weights)]
+            with db:
+                cursor.executemany("INSERT OR IGNORE INTO picture_tags (picture_id, tag_id) VALUES (?, ?)", zip(
+                    np.repeat(chunk, counts).tolist(), drawn.tolist()))
+    return picture_ids.astype(np.int64)
+
+
+def populate_images(db, folder: str, picture_ids, count: int, rng, image_size=(1200, 1600)):
+    # write count synthetic JPEG images (smooth gradients plus noise, so that they compress like illustrations rather than pure noise) and point random pictures at them
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    width, height = image_size
+    gradient = np.add.outer(np.linspace(0, 160, height),
+                            np.linspace(0, 80, width))
+    updates = []
+    for picture_id in rng.choice(picture_ids, size=min(count, len(picture_ids)), replace=False):
+        pixels = gradient[:, :, None] + rng.integers(0, 24, (height, width, 3)) + \
+            rng.integers(0, 64, 3)
+        filename = os.path.join(folder, "{}.jpg".format(picture_id))
+        Image.fromarray(np.clip(pixels, 0, 255).astype(
+            np.uint8)).save(filename, quality=95)
+        updates.append((filename, int(picture_id)))
+    with db:
+        db.cursor().executemany(
+            "UPDATE pictures SET local_filename = ? WHERE picture_id = ?", updates)
+    return [picture_id for _, picture_id in updates]
+
+
+def time_call(func, repeat: int):
+    # latency statistics in milliseconds
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return {"median_ms": round(float(np.median(timings)), 3), "p95_ms": round(float(np.percentile(timings, 95)), 3), "min_ms": round(float(np.min(timings)), 3), "repeat": repeat}
+
+
+def record(results, suite: str, case: str, rows: int, stats: dict):
+    results.append(dict({"suite": suite, "case": case, "rows": rows}, **stats))
+    # one-off runs (generation, compression) report their total time in seconds instead of latencies
+    print("{:>10} | {:<10} | {:<50} | {:>14} | {:>14}{}".format(rows, suite, case, str(stats["median_ms"]) + "ms" if "median_ms" in stats else str(stats.get("seconds")) + "s", str(stats["p95_ms"]) + "ms" if "p95_ms" in stats else "", " | {} {}".format(stats["throughput"], stats["unit"]) if "throughput" in stats else ""))
+
+
+def sample_picture_ids(cursor, ids, num: int, where: str = "", rng=None, rejection: bool = True, max_rounds: int = 4):
+    # pick up to num distinct picture_ids uniformly at random from ids, keeping only those that match the where clause
+    # baseline of the in-memory index: filters are checked in SQL on random candidates instead of in numpy
+    rng = rng or np.random.default_rng()
+    if len(ids) == 0:
+        return []
+    if not where:
+        return [int(x) for x in rng.choice(ids, size=min(num, len(ids)), replace=False)]
+    if rejection:
+        # rejection sampling: draw random candidates and keep the matching ones, works well for broad filters (e.g. r18/orientation)
+        batch_size = min(len(ids), max(num * 16, 256))
+        found = []
+        found_set = set()
+        for _ in range(max_rounds):
+            candidates = rng.choice(ids, size=batch_size, replace=False)
+            cursor.execute("SELECT picture_id FROM pictures WHERE picture_id IN ({}) AND ({})".format(
+                ",".join(str(int(x)) for x in candidates), where))
+            matched = set(row[0] for row in cursor.fetchall())
+            # keep the random order in which candidates were drawn
+            for x in candidates:
+                x = int(x)
+                if x in matched and x not in found_set:
+                    found.append(x)
+                    found_set.add(x)
+                    if len(found) >= num:
+                        return found
+            if batch_size == len(ids):
+                # every id has been checked, so found already holds all matching ids
+                return found
+    # narrow filters: collect the matching ids (no sorting) and pick from them
+    cursor.execute(
+        "SELECT picture_id FROM pictures WHERE ({})".format(where))
+    matched = [row[0] for row in cursor.fetchall()]
+    if not matched:
+        return []
+    return [int(x) for x in rng.choice(matched, size=min(num, len(matched)), replace=False)]
+
+
+def benchmark_random(results, db, size: int, picture_ids, num: int = 1, repeat: int = 20, rng=None):
+    # ORDER BY RANDOM() against the sampler and the in-memory index
+    # filter name: (SQL where clause, in-memory index filters)
+    filters = {"any": ("", {}), "r18 == 0": ("r18 == 0", {"r18": 0}), "r18 == 1 AND orientation == 0": (
+        "r18 == 1 AND orientation == 0", {"r18": 1, "orientation": 0})}
+    cursor = db.cursor()
+    for name, (where, index_filters) in filters.items():
+        record(results, "random", "ORDER BY RANDOM() " + name, size, time_call(lambda: cursor.execute("SELECT * FROM pictures WHERE picture_id IN (SELECT picture_id FROM pictures {}ORDER BY RANDOM() LIMIT {})".format(
+            "WHERE ({}) ".format(where) if where else "", num)).fetchall(), repeat))
+        record(results, "random", "sampler " + name, size, time_call(lambda: sample_picture_ids(
+            cursor, picture_ids, num, where, rng), repeat))
+        record(results, "random", "index " + name, size, time_call(lambda: cursor.execute("SELECT * FROM pictures WHERE picture_id IN ({})".format(", ".join(str(picture_id) for picture_id in sample_picture_ids(
+            cursor, filter_picture_ids(**index_filters), num, "", rng)))).fetchall(), repeat))
+
+
+def use_database(db_path: str):
+    # point the crawler and the API at a synthetic database, dropping everything cached from the previous one
+    import pixiv_crawler
+    import pixiv_database
+    pixiv_crawler.db.close()
+    pixiv_crawler.db = initDB(db_path)
+    pixiv_crawler.db_path = db_path
+    load_picture_index(pixiv_crawler.db)
+    with pixiv_database.query_cache_lock:
+        pixiv_database.query_cache.clear()
+        pixiv_database.query_cache_bytes = 0
+    pixiv_database.invalidate_tag_cache()
+    pixiv_database.bump_generation()
+
+
+def benchmark_hot_paths(results, size: int, repeat: int = 20, num: int = 20, tag_vocab: int = 0, batch_size: int = 30):
+    # randomDB, tagDB and insertManyDB as called by the API and the crawler
+    import pixiv_crawler
+    import pixiv_crawler_api
+    record(results, "hot_path", "randomDB num={}".format(num), size, time_call(
+        lambda: pixiv_crawler_api.randomDB(num=num), repeat))
+    record(results, "hot_path", "randomDB r18=0 orientation=1", size, time_call(
+        lambda: pixiv_crawler_api.randomDB(r18=0, orientation=1), repeat))
+    if tag_vocab:
+        # a common and a rare tag (tags are drawn following Zipf's law by default)
+        record(results, "hot_path", "randomDB tags=[tag0]", size, time_call(
+            lambda: pixiv_crawler_api.randomDB(tags=["tag0"]), repeat))
+        record(results, "hot_path", "randomDB tags=[tag{}]".format(tag_vocab - 1), size, time_call(
+            lambda: pixiv_crawler_api.randomDB(tags=["tag{}".format(tag_vocab - 1)]), repeat))
+    picked = [item["picture_id"]
+              for item in pixiv_crawler_api.randomDB(num=num)]
+    record(results, "hot_path", "tagDB {} pictures".format(len(picked)), size, time_call(
+        lambda: pixiv_crawler_api.tagDB(picked), repeat))
+    # a ranking page worth of new illusts per call
+    next_id = [10 ** 9]
+
+    def insert_batch():
+        items = []
+        for _ in range(batch_size):
+            next_id[0] += 1
+            items.append(("{}_0".format(next_id[0]), {"id": next_id[0], "author_id": next_id[0] % 1000, "author_name": "author", "title": "title", "page_no": 0, "page_count": 1, "orientation": 1, "r18": 0,
+                         "ai_type": 0, "url": "https://i.pximg.net/{}.jpg".format(next_id[0]), "local_filename": "", "tags": [{"name": "tag{}".format(next_id[0] % max(tag_vocab, 1)), "translated_name": None}]}))
+        pixiv_crawler.insertManyDB(items)
+    stats = time_call(insert_batch, repeat)
+    stats.update({"throughput": round(batch_size / stats["median_ms"] * 1000, 1),
+                  "unit": "rows/s"})
+    record(results, "hot_path", "insertManyDB batch={}".format(batch_size), size, stats)
+
+
+def benchmark_endpoints(results, size: int, local_picture_ids, repeat: int = 20):
+    # API endpoints through FastAPI's TestClient (in process, so that only the application is measured)
+    import pixiv_crawler_api
+    from fastapi.testclient import TestClient
+    client = TestClient(pixiv_crawler_api.app)
+    cases = [("/api/v1", {}), ("/api/v1", {"num": 20}), ("/api/v1", {"r18": 0, "orientation": 1}),
+             ("/api/v1", {"tags": "tag0"}), ("/api/v1/redirect", {}), ("/metrics", {})]
+    if local_picture_ids:
+        picture_id = local_picture_ids[0]
+        client.get("/api/v1/img/{}".format(picture_id),
+                   params={"width": 360, "format": "webp"})
+        cases += [("/api/v1/img", {}), ("/api/v1/img/{}".format(picture_id), {}),
+                  ("/api/v1/img/{}".format(picture_id), {"width": 360, "format": "webp"})]
+    for path, params in cases:
+        record(results, "endpoint", "GET " + path + ("?" + "&".join("{}={}".format(key, value) for key, value in params.items()) if params else ""), size, time_call(
+            lambda: client.get(path, params=params, follow_redirects=False), repeat))
+
+
+def benchmark_compress(results, size: int, count: int, processes: int = 0):
+    # one compress_images task over every synthetic image, reported as images per second
+    import pixiv_crawler
+    pixiv_crawler.compress_processes = processes
+    start_time = time.perf_counter()
+    pixiv_crawler.compress_images()
+    elapsed = time.perf_counter() - start_time
+    record(results, "compress", "compress_images {} images, {} processes".format(count, processes or os.cpu_count()), size, {
+           "seconds": round(elapsed, 3), "throughput": round(count / elapsed, 2) if elapsed else 0, "unit": "images/s"})
+
+
+def benchmark_crawl(results, folder: str, days: int = 3, pages: int = 5, latency: float = 0, image_latency: float = 0, rate_limit_ratio: float = 0, crawl_threads: int = 4, download_threads: int = 8):
+    # a whole crawl (ranking pages, database insertion and downloads) from the local fake Pixiv service into an empty database
+    import pixiv_http
+    import pixiv_crawler
+    from pixiv_fake_service import FakePixivService
+    service = FakePixivService(pages=pages, latency=latency, image_latency=image_latency,
+                               rate_limit_ratio=rate_limit_ratio)
+    service.start()
+    try:
+        config = configupdater.ConfigUpdater()
+        config.read("config.ini", encoding="utf-8")
+        for key, value in {"api_host": service.url, "store_mode": "full", "download_folder": os.path.join(folder, "downloads"), "get_all_ranking_pages": "True", "crawl_threads": crawl_threads,
+                           "download_threads": download_threads, "max_requests_per_minute": 0, "max_downloads_per_minute": 0}.items():
+            config.set("Crawler", key, str(value))
+        with open("config.ini", "w", encoding="utf-8") as configfile:
+            config.write(configfile)
+        pixiv_crawler.read_config()
+        # injected rate limits are retried after milliseconds instead of Pixiv's backoff of tens of seconds
+        pixiv_crawler.api_rate_limiter.backoff_base = 0.05
+        pixiv_crawler.auth_api()
+        use_database(os.path.join(folder, "crawl.sqlite3"))
+        dates = [(datetime.date(2024, 1, 1) + datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+                 for i in range(days)]
+        http_before = pixiv_http.get_stats().get(service.host, {})
+        start_time = time.perf_counter()
+        pixiv_crawler.crawl_images(True, False, dates)
+        elapsed = time.perf_counter() - start_time
+        pictures = pixiv_crawler.lenDB()
+        case = "crawl {} days x {} modes x {} pages, {} crawl / {} download threads".format(
+            days, len(pixiv_crawler.get_list(pixiv_crawler.ranking_modes)), pages, crawl_threads, download_threads)
+        record(results, "crawl", case + " (pictures)", pictures, dict(service.stats, **{
+               "seconds": round(elapsed, 3), "throughput": round(pictures / elapsed, 1), "unit": "illusts/s"}))
+        record(results, "crawl", case + " (downloads)", pictures, dict(service.stats, **{"seconds": round(
+            elapsed, 3), "throughput": round(service.stats["image_bytes"] / elapsed / 1024 / 1024, 2), "unit": "MB/s"}))
+        http = dict((key, value - http_before.get(key, 0))
+                    for key, value in pixiv_http.get_stats().get(service.host, {}).items())
+        record(results, "crawl", case + " (connections)", pictures, dict(http, **{"seconds": round(
+            elapsed, 3), "throughput": round(http["reused"] * 100 / http["requests"], 1) if http.get("requests") else 0, "unit": "% requests on reused connections"}))
+    finally:
+        service.stop()
+
+
+def substring_in_list(s, substrings):
+    # excluding_tags matcher used by the crawler before TagMatcher, kept as the baseline of benchmark_excluding_tags
+    for substring in substrings:
+        if substring.startswith('*') and substring.endswith('*'):
+            substring = substring.replace('*', '')
+            if substring in s:
+                return True
+        elif substring.startswith('*'):
+            substring = substring.replace('*', '') + '$'
+            if re.search(substring, s):
+                return True
+        elif substring.endswith('*'):
+            substring = '^' + substring.replace('*', '')
+            if re.search(substring, s):
+                return True
+        else:
+            if substring == s:
+                return True
+    return False
+
+
+def benchmark_excluding_tags(results, rng, count: int = 20000, repeat: int = 20):
+    # crawl filter over count (name, translated_name) tags: substring_in_list against TagMatcher, with the default excluding_tags and a long list
+    default_patterns = ["manga", "muscle", "otokonoko", "young boy", "shota", "furry", "gay",
+                        "homo", "bodybuilding", "macho", "yaoi", "futa", "futanari", "*漫画*"]
+    words = ["girl", "original", "landscape", "manga", "furry", "cat", "漫画", "sky", "yaoi",
+             "blue hair", "genshin impact", "macho", "school uniform", "fantasy", "shota", "night"]
+    tags = []
+    for _ in range(count):
+        name = " ".join(rng.choice(words, size=int(rng.integers(1, 3))))
+        tags.append((name, name.upper() if rng.random() < 0.5 else None))
+    long_patterns = default_patterns + ["{}{}{}".format("*" if i % 3 else "", word, "*" if i % 2 else "")
+                                        for i, word in enumerate("pattern{}".format(i) for i in range(200))]
+    for name, patterns in [("default excluding_tags", default_patterns), ("{} patterns".format(len(long_patterns)), long_patterns)]:
+        patterns = [pattern.lower() for pattern in patterns]
+        matcher = TagMatcher(patterns)
+        expected = [(tag_name is not None and substring_in_list(tag_name.lower(), patterns)) or (
+            translated_name is not None and substring_in_list(translated_name.lower(), patterns)) for tag_name, translated_name in tags]
+        if expected != [matcher.match(tag_name) or matcher.match(translated_name) for tag_name, translated_name in tags]:
+            raise AssertionError("TagMatcher and substring_in_list disagree on " + name)
+        for case, func in [("substring_in_list", lambda: [(tag_name is not None and substring_in_list(tag_name.lower(), patterns)) or (translated_name is not None and substring_in_list(translated_name.lower(), patterns)) for tag_name, translated_name in tags]),
+                           ("TagMatcher", lambda: [matcher.match(tag_name) or matcher.match(translated_name) for tag_name, translated_name in tags])]:
+            stats = time_call(func, repeat)
+            stats.update({"throughput": round(count / stats["median_ms"] * 1000), "unit": "tags/s"})
+            record(results, "tags", "{} {}, {} matched".format(case, name, sum(expected)), count, stats)
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    results = []
+    print("{:>10} | {:<10} | {:<50} | {:>14} | {:>14}".format(
+        "rows", "suite", "case", "median", "p95"))
+    with tempfile.TemporaryDirectory() as folder:
+        # the crawler and the API read config.ini and open their database in the working directory on import
+        working_directory = os.getcwd()
+        os.chdir(folder)
+        try:
+            with open("config.ini", "w", encoding="utf-8") as configfile:
+                configfile.write("[Crawler]\nupdate_interval = 0\nverify_interval = 0\n\n[API]\nderivative_folder = {}\nimage_num_limit = 100\n".format(
+                    os.path.join(folder, "derivatives")))
+            if set(args.suites) - {"random", "excluding_tags"}:
+                logging.getLogger("uvicorn").setLevel(logging.ERROR)
+                import pixiv_crawler_api
+                # the API is not started, so its config is read here instead of in the startup event (which also logs in to Pixiv)
+                pixiv_crawler_api.logger = logging.getLogger("uvicorn")
+                pixiv_crawler_api.read_config()
+            # the crawl benchmark starts from an empty database of its own
+            for size in args.sizes if set(args.suites) - {"crawl", "excluding_tags"} else []:
+                db_path = os.path.join(folder, "db_{}.sqlite3".format(size))
+                db = initDB(db_path)
+                start_time = time.perf_counter()
+                picture_ids = populate_pictures(
+                    db, size, rng, args.tag_vocab, args.tags_per_image, args.tag_distribution)
+                local_picture_ids = populate_images(db, os.path.join(folder, "images_{}".format(size)), picture_ids, args.images, rng, tuple(
+                    args.image_size)) if args.images and set(args.suites) & {"endpoints", "compress"} else []
+                record(results, "generate", "synthetic database", size, {
+                       "seconds": round(time.perf_counter() - start_time, 3)})
+                load_picture_index(db)
+                if "random" in args.suites:
+                    benchmark_random(results, db, size, picture_ids,
+                                     args.num, args.repeat, rng)
+                db.close()
+                if set(args.suites) - {"random", "excluding_tags"}:
+                    use_database(db_path)
+                if "hot_paths" in args.suites:
+                    benchmark_hot_paths(
+                        results, size, args.repeat, tag_vocab=args.tag_vocab)
+                if "endpoints" in args.suites:
+                    benchmark_endpoints(
+                        results, size, local_picture_ids, args.repeat)
+                if "compress" in args.suites and local_picture_ids:
+                    benchmark_compress(results, size, len(
+                        local_picture_ids), args.compress_processes)
+            if "excluding_tags" in args.suites:
+                benchmark_excluding_tags(results, rng, repeat=args.repeat)
+            if "crawl" in args.suites:
+                benchmark_crawl(results, folder, args.crawl_days, args.crawl_pages, args.crawl_latency, args.crawl_image_latency,
+                                args.crawl_rate_limit_ratio, args.crawl_threads, args.download_threads)
+        finally:
+            os.chdir(working_directory)
+    if args.output:
+        # machine-readable results, so that runs could be compared across commits
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump({"commit": get_commit(), "timestamp": time.time(), "python": platform.python_version(), "platform": platform.platform(
+            ), "cpu_count": os.cpu_count(), "args": vars(args), "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000], help="number of synthetic pictures (10k to 5M)")
+    parser.add_argument("--num", type=int, default=1,
+                        help="number of random pictures per call")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of timed calls per case")
+    parser.add_argument("--suites", nargs="+", default=["random", "hot_paths", "endpoints", "compress", "crawl", "excluding_tags"], choices=[
+                        "random", "hot_paths", "endpoints", "compress", "crawl", "excluding_tags"], help="benchmarks to run")
+    parser.add_argument("--tag-vocab", type=int, default=20000,
+                        help="number of distinct synthetic tags")
+    parser.add_argument("--tags-per-image", type=float, default=6,
+                        help="mean number of tags per picture (Poisson distributed)")
+    parser.add_argument("--tag-distribution", default="zipf",
+                        choices=["zipf", "uniform"], help="popularity distribution of tags")
+    parser.add_argument("--images", type=int, default=50,
+                        help="number of synthetic image files per database")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[1200, 1600],
+                        metavar=("WIDTH", "HEIGHT"), help="size of synthetic image files")
+    parser.add_argument("--compress-processes", type=int, default=0,
+                        help="processes of the compression benchmark (0 = one per CPU core)")
+    parser.add_argument("--crawl-days", type=int, default=3,
+                        help="dates crawled by the crawl benchmark (from the local fake Pixiv service)")
+    parser.add_argument("--crawl-pages", type=int, default=5,
+                        help="ranking pages per date and mode of the crawl benchmark")
+    parser.add_argument("--crawl-latency", type=float, default=0,
+                        help="seconds added to every ranking page response")
+    parser.add_argument("--crawl-image-latency", type=float, default=0,
+                        help="seconds added to every image response")
+    parser.add_argument("--crawl-rate-limit-ratio", type=float, default=0,
+                        help="share of ranking requests answered with a rate limit error")
+    parser.add_argument("--crawl-threads", type=int, default=4,
+                        help="crawl_threads of the crawl benchmark")
+    parser.add_argument("--download-threads", type=int, default=8,
+                        help="download_threads of the crawl benchmark")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the synthetic data generator")
+    parser.add_argument("--output", default="",
+                        help="write results as JSON to this file")
+    main(parser.parse_args())
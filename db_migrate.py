@@ -0,0 +1,91 @@
+import os
+import time
+import xxhash
+import pixiv_http
+
+from concurrent.futures import ThreadPoolExecutor
+from pixiv_image_probe import get_image_size
+
+# shared by db_migrate_SQLite and db_migrate_TinyDB
+# pixiv_crawler is imported when migrating only, as importing it opens the database of config.ini
+
+
+def probe_size(session, local_filename: str, url: str, reverse_proxy: str):
+    # (width, height) of a picture from the header of its local file if it exists, of its (reverse proxied) url otherwise
+    # returns (size, source), source is one of local, remote, default (size is None then)
+    if local_filename and os.path.exists(local_filename):
+        try:
+            return get_image_size(local_filename), "local"
+        except Exception:
+            pass
+    if url:
+        try:
+            return get_image_size(url.replace("i.pximg.net", reverse_proxy), session), "remote"
+        except Exception:
+            pass
+    return None, "default"
+
+
+def migrate(db, batches, total: int, checkpoint_key: str, reverse_proxy: str = "i.pixiv.re", force_update: bool = False, probe_threads: int = 16):
+    # write batches of (checkpoint, pk, data) items into db, each batch in one transaction
+    # items without an orientation or a size are probed concurrently (header only, local file first), the checkpoint of the last item is saved after every batch
+    import pixiv_crawler
+    cursor = db.cursor()
+    # every probing thread keeps a keep-alive connection in the shared pools
+    pixiv_http.reserve_connections(probe_threads)
+    session = pixiv_http.get_session()
+    stats = {"migrated": 0, "skipped": 0,
+             "local": 0, "remote": 0, "default": 0}
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=probe_threads) as executor:
+        for batch in batches:
+            if not batch:
+                continue
+            checkpoint = batch[-1][0]
+            if not force_update and db is pixiv_crawler.db:
+                # records already in the database (e.g. from an earlier run) are skipped before their images are probed
+                known = pixiv_crawler.known_picture_ids(
+                    [xxhash.xxh32_intdigest(pk) for _, pk, _ in batch])
+                stats["skipped"] += int(known.sum())
+                batch = [item for item, is_known in zip(batch, known) if not is_known]
+            for _, _, data in batch:
+                if data.get("orientation") is None and data.get("width") and data.get("height"):
+                    data["orientation"] = pixiv_crawler.get_image_orientation(data["width"], data["height"])
+            probes = [(data, executor.submit(probe_size, session, data["local_filename"], data["url"], reverse_proxy))
+                      for _, _, data in batch if data.get("orientation") is None or data.get("width") is None]
+            for data, future in probes:
+                size, source = future.result()
+                stats[source] += 1
+                if size:
+                    data["width"], data["height"] = size
+                    if data.get("orientation") is None:
+                        data["orientation"] = pixiv_crawler.get_image_orientation(*size)
+                elif data.get("orientation") is None:
+                    data["orientation"] = 0
+                    print("Failed to get orientation for picture " + str(data["id"]) +
+                          "_p" + str(data["page_no"]) + ", assigning 0 (Landscape) as default.")
+            results = pixiv_crawler.insertManyDB([(pk, data)
+                                                 for _, pk, data in batch], force_update, db)
+            cursor.execute("INSERT OR REPLACE INTO crawler_state (key, value) VALUES (?, ?)",
+                           (checkpoint_key, checkpoint))
+            for (_, pk, _), result in zip(batch, results):
+                if not result:
+                    print("Skipped " + str(pk) + ", it is already in the database or could not be inserted.")
+            stats["migrated"] += results.count(True)
+            stats["skipped"] += results.count(False)
+            done = stats["migrated"] + stats["skipped"]
+            elapsed = time.time() - start_time
+            print("Processed {}/{} records ({} records/s, {} skipped), size from {} local files, {} URLs, {} failed".format(
+                done, total, round(done / elapsed, 1) if elapsed else 0, stats["skipped"], stats["local"], stats["remote"], stats["default"]))
+    cursor.execute("DELETE FROM crawler_state WHERE key = ?",
+                   (checkpoint_key,))
+    print("Migration finished. {}/{} records migrated in {}s.".format(
+        stats["migrated"], total, round(time.time() - start_time, 2)))
+    return stats
+
+
+def get_checkpoint(db, checkpoint_key: str):
+    # checkpoint of an interrupted migration into db, None if there is none
+    row = db.cursor().execute(
+        "SELECT value FROM crawler_state WHERE key = ?", (checkpoint_key,)).fetchone()
+    return row[0] if row else None
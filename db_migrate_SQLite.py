@@ -1,57 +1,23 @@
-import traceback
 import apsw
 import os
-import xxhash
 
-def tagDB(db, picture_id: str):
-    cursor = db.cursor()
-    results = cursor_to_dict(cursor,
-        "SELECT name, translated_name FROM tags WHERE tag_id IN (SELECT tag_id FROM picture_tags WHERE picture_id == '" + picture_id + "')")
-    return results
+from db_migrate import migrate, get_checkpoint
 
-def insertDB(db, pk, data, force_update=False):
-    # convert pk into xxhash integer
-    pk = xxhash.xxh32_intdigest(pk)
-    try:
-        # create a cursor object
-        cursor = db.cursor()
-        # check if force_update is True
-        if force_update:
-            # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-            cursor.execute("INSERT OR REPLACE INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url, local_filename, local_filename_compressed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ((
-                pk), data["id"], data["author_id"], data["author_name"], data["title"], data["page_no"], data["page_count"], data["orientation"], data["r18"], data["ai_type"], data["url"], data["local_filename"], data["local_filename_compressed"]))
-            # commit changes
-            # commit by apsw
-            # insert tags
-            for tag in data["tags"]:
-                # calculate tag_id by hashing tag name
-                tag_id = xxhash.xxh32_intdigest(str(tag["name"]))
-                # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-                cursor.execute("INSERT OR REPLACE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)", ((tag_id, tag["name"], tag["translated_name"])))
-                # commit changes
-                # commit by apsw
-                # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-                cursor.execute(
-                    "INSERT OR REPLACE INTO picture_tags (picture_id, tag_id) VALUES (?, (SELECT tag_id FROM tags WHERE name = ?))", ((pk), tag["name"]))
-                # commit changes
-                # commit by apsw
-        return True
-    except apsw.ConstraintError as e:
-        if force_update:
-            print(
-                "Aborting database insertion for picture_id: " + str(pk) + " due to error: " + str(e))
-        return False
-    except Exception as e:
-        print("Aborting database insertion for picture_id: " + str(pk) + " due to error: " +
-              str(e) + "\n" + traceback.format_exc())
-        return False
 
-def migrateDB(db, db_old, reverse_proxy):
-    # transform the old database to the new database
-    cursor = db_old.cursor()
-    results = cursor_to_dict(cursor, "SELECT * FROM pictures")
-    success_count = 0
-    for item in results:
+def get_tags(db_old, picture_ids):
+    # tags of a chunk of pictures with one query, returns {picture_id: [{"name": ..., "translated_name": ...}]}
+    tags = dict((picture_id, []) for picture_id in picture_ids)
+    for picture_id, name, translated_name in db_old.cursor().execute("SELECT picture_tags.picture_id, tags.name, tags.translated_name FROM picture_tags JOIN tags ON tags.tag_id = picture_tags.tag_id WHERE picture_tags.picture_id IN ({})".format(
+            ", ".join("?" * len(tags))), list(tags)):
+        tags[picture_id].append({"name": name, "translated_name": translated_name})
+    return tags
+
+
+def get_batches(db_old, after, batch_size):
+    # chunks of (picture_id, pk, data) in picture_id order, read with keyset pagination so that memory does not grow with the table
+    from pixiv_crawler import iterate_pictures
+    items = []
+    for item in iterate_pictures(db_old, after=after, chunk_size=batch_size):
         data = {
             "id": item["id"],
             "author_id": item["author_id"],
@@ -64,25 +30,34 @@ def migrateDB(db, db_old, reverse_proxy):
             "url": item["url"],
             "local_filename": item["local_filename"],
             "local_filename_compressed": item["local_filename_compressed"] if "local_filename_compressed" in item else "",
+            "width": item.get("width"),
+            "height": item.get("height"),
+            "orientation": None,
         }
-        pk = item["picture_id"]
-        data["tags"] = tagDB(db_old, pk)
-        try:
-            data["orientation"] = get_image_orientation_from_source(
-                data["local_filename"])
-        except Exception:
-            try:
-                # If the file is not found, try to use url instead
-                data["orientation"] = get_image_orientation_from_source(
-                    data["url"].replace("i.pximg.net", reverse_proxy))
-            except Exception:
-                print("Failed to get orientation for picture_id: " + str(pk) + ", assigning 0 (Portrait) as default.")
-                data["orientation"] = 0
-        result = insertDB(db, pk, data, True)
-        print("Migrating {}... {}".format(
-            pk, "Success" if result else "Failed"))
-        success_count += 1 if result else 0
-    print("Migration finished. {}/{} records migrated.".format(success_count, len(results)))
+        items.append((item["picture_id"], item["picture_id"], data))
+        if len(items) >= batch_size:
+            yield add_tags(db_old, items)
+            items = []
+    yield add_tags(db_old, items)
+
+
+def add_tags(db_old, items):
+    if items:
+        tags = get_tags(db_old, [picture_id for picture_id, _, _ in items])
+        for picture_id, _, data in items:
+            data["tags"] = tags[picture_id]
+    return items
+
+
+def migrateDB(db, db_old, reverse_proxy, batch_size=500, probe_threads=16):
+    # transform the old database to the new database
+    # the last migrated picture_id is saved in the new database after every batch, so that an interrupted migration could be resumed
+    after = get_checkpoint(db, "migrate_last_picture_id")
+    if after is not None:
+        print("Resuming migration after picture_id " + str(after) + ".")
+    total = db_old.cursor().execute("SELECT COUNT(*) FROM pictures{}".format(
+        " WHERE picture_id > ?" if after is not None else ""), [after] if after is not None else []).fetchone()[0]
+    return migrate(db, get_batches(db_old, after, batch_size), total, "migrate_last_picture_id", reverse_proxy, True, probe_threads)
 
 
 if __name__ == "__main__":
@@ -91,10 +66,14 @@ if __name__ == "__main__":
         "Please enter the path of the SQLite database file (default: db.sqlite3): ") or "db.sqlite3"
     reverse_proxy = input(
         "Please enter the reverse proxy for the image URL (default: i.pixiv.re): ") or "i.pixiv.re"
-    # rename the database file to the backup file
-    os.rename(db_path, db_path + ".bak")
-    # import necessary functions from pixiv_crawler
-    from pixiv_crawler import initDB, cursor_to_dict, get_image_orientation_from_source
+    if os.path.exists(db_path + ".bak"):
+        # the backup file is left by an interrupted migration, keep it and continue the migration
+        print("Backup file " + db_path + ".bak found, continuing the previous migration.")
+    else:
+        # rename the database file to the backup file
+        os.rename(db_path, db_path + ".bak")
+    # pixiv_crawler opens the database of config.ini on import, so it is imported after the rename
+    from pixiv_crawler import initDB
     db_old = apsw.Connection(db_path + ".bak")
     db = initDB(db_path)
     migrateDB(db, db_old, reverse_proxy)
@@ -1,13 +1,15 @@
-from pixiv_crawler import initDB, insertDB
+import pixiv_crawler
+
 from tinydb import TinyDB
+from db_migrate import migrate, get_checkpoint
 
 
-def migrateDB(db_path: str = "db.json"):
-    # transform the database from tinydb to sqlite3
-    tinydb = TinyDB(db_path, ensure_ascii=False, encoding='utf-8')
-    tinydb = tinydb.table("_default", cache_size=None)
-    success_count = 0
-    for item in tinydb.all():
+def get_batches(table, after, batch_size):
+    # chunks of (doc_id, pk, data) in doc_id order, documents up to after were migrated by an interrupted migration
+    items = []
+    for item in table:
+        if after is not None and item.doc_id <= after:
+            continue
         data = {
             "id": item["id"],
             "author_id": item["author_id"],
@@ -21,22 +23,37 @@ def migrateDB(db_path: str = "db.json"):
             "url": item["url"],
             "local_filename": item["local_filename"],
             "local_filename_compressed": item["local_filename_compressed"] if "local_filename_compressed" in item else "",
+            "width": item.get("width"),
+            "height": item.get("height"),
+            # TinyDB records have no orientation, it is probed from the image
+            "orientation": item.get("orientation"),
         }
         pk = str(item["id"]) + "_p" + str(item["page_no"])
-        result = insertDB(pk, data, False)
-        print("Migrating {}... {}".format(
-            pk, "Success" if result else "Failed"))
-        success_count += 1 if result else 0
-    print("Migration finished. {}/{} records migrated.".format(success_count, len(tinydb)))
+        items.append((item.doc_id, pk, data))
+        if len(items) >= batch_size:
+            yield items
+            items = []
+    yield items
+
+
+def migrateDB(db_path: str = "db.json", reverse_proxy: str = "i.pixiv.re", batch_size: int = 500, probe_threads: int = 16):
+    # transform the database from tinydb to sqlite3
+    tinydb = TinyDB(db_path, ensure_ascii=False, encoding='utf-8')
+    tinydb = tinydb.table("_default", cache_size=None)
+    db = pixiv_crawler.db
+    after = get_checkpoint(db, "migrate_tinydb_last_doc_id")
+    if after is not None:
+        # checkpoints are stored as text
+        after = int(after)
+        print("Resuming migration after document " + str(after) + ".")
+    total = sum(1 for item in tinydb if after is None or item.doc_id > after)
+    return migrate(db, get_batches(tinydb, after, batch_size), total, "migrate_tinydb_last_doc_id", reverse_proxy, False, probe_threads)
 
 
 if __name__ == "__main__":
     # transform the database from tinydb to sqlite3 according to the path given in the user input
     db_path = input(
         "Please enter the path of the TinyDB database file (default: db.json): ") or "db.json"
-    db = initDB()
-
-    if db_path == "":
-        migrateDB()
-    else:
-        migrateDB(db_path)
+    reverse_proxy = input(
+        "Please enter the reverse proxy for the image URL (default: i.pixiv.re): ") or "i.pixiv.re"
+    migrateDB(db_path, reverse_proxy)
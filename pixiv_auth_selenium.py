@@ -6,6 +6,7 @@ import logging
 import requests
 import traceback
 import configupdater
+import pixiv_http
 
 from argparse import ArgumentParser
 from base64 import urlsafe_b64encode
@@ -64,6 +65,8 @@ if (global_proxy != ""):
     }
 else:
     REQUESTS_KWARGS = {}
+# the shared HTTP transport goes through the same proxy (pixiv_crawler sizes its pools)
+pixiv_http.configure(global_proxy)
 
 global_refresh_token = ""
 global_expires_in = -1
@@ -220,7 +223,7 @@ def login(visible=False, log_info=False):
 
     while True:
         try:
-            response = requests.post(
+            response = pixiv_http.get_session().post(
                 AUTH_TOKEN_URL,
                 data={
                     "client_id": CLIENT_ID,
@@ -256,7 +259,7 @@ def login(visible=False, log_info=False):
 
 
 def refresh(refresh_token, log_info=False):
-    response = requests.post(
+    response = pixiv_http.get_session().post(
         AUTH_TOKEN_URL,
         data={
             "client_id": CLIENT_ID,
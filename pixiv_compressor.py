@@ -0,0 +1,67 @@
+import os
+import uuid
+
+from PIL import Image, ImageFile, UnidentifiedImageError
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def compress_image(image_path, output_path, quality):
+    image = Image.open(image_path)
+    image = image.convert('RGB')
+    image.save(output_path, optimize=True, quality=quality)
+
+
+def compress_job(job):
+    # compress one image, run in a worker process of the compression pool (this module has no side effects on import)
+    # returns (picture_id, status, local_filename, local_filename_compressed), status is one of compressed, missing, invalid
+    # originals are never deleted here, as they may be shared with other pictures
+    picture_id, original_filename, compressed_filename, quality = job
+    if not os.path.exists(original_filename):
+        return picture_id, "missing", original_filename, compressed_filename
+    try:
+        compress_image(original_filename, compressed_filename, quality)
+    except (FileNotFoundError, UnidentifiedImageError):
+        return picture_id, "invalid", original_filename, compressed_filename
+    return picture_id, "compressed", original_filename, compressed_filename
+
+
+def make_derivative(image_path, output_path, width, format, quality):
+    # resize (never upscale) and re-encode an image, JPEG sources are decoded at a reduced scale in draft mode when downscaling
+    # width of 0 keeps the original width, format is one of webp, jpeg
+    with Image.open(image_path) as image:
+        if width and width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image.draft("RGB", (width, height))
+            image = image.convert("RGB")
+            if image.width > width:
+                image = image.resize((width, height), Image.LANCZOS)
+        else:
+            image = image.convert("RGB")
+        # written under a temporary name and renamed, so that concurrent requests never serve a partly written file
+        temp_path = "{}.{}.tmp".format(output_path, uuid.uuid4().hex)
+        try:
+            image.save(temp_path, format.upper(), quality=quality)
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def verify_job(job):
+    # check one image in a worker process of the verification pool, returns (picture_id, filename, only_compressed, valid)
+    # headers are parsed by default, full_decode decodes the whole image so that truncated images are found as well
+    picture_id, filename, only_compressed, full_decode = job
+    ImageFile.LOAD_TRUNCATED_IMAGES = False
+    try:
+        with Image.open(filename) as image:
+            if full_decode:
+                image.load()
+            else:
+                image.verify()
+        valid = True
+    except Exception:
+        valid = False
+    finally:
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return picture_id, filename, only_compressed, valid
@@ -1,17 +1,29 @@
-import apsw
 import time
 import logging
 import traceback
 import os
 import re
-import requests
 import unicodedata
 import configupdater
 import xxhash
+import queue
+import threading
+import itertools
+import json
+import shutil
+import multiprocessing
+import pixiv_metrics
+import pixiv_http
 
-from PIL import Image, ImageFile, UnidentifiedImageError
+from PIL import Image, ImageFile
 from pixivpy3 import *
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from pixiv_rate_limiter import RateLimiter, RateLimitException
+from pixiv_tag_matcher import TagMatcher
+from pixiv_image_probe import get_image_size
+from pixiv_compressor import compress_job, verify_job
 from pixiv_auth_selenium import get_refresh_token, get_token_expiration, get_proxy
+from pixiv_database import initDB, get_read_connection, cursor_to_dict, iterate_pictures, load_picture_index, add_picture_index, update_picture_index, known_picture_ids, invalidate_tag_cache, bump_generation
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -34,177 +46,118 @@ def slugify(value, allow_unicode=False):
     return re.sub(r'[-\s]+', '-', value).strip('-_')
 
 
-def substring_in_list(s, substrings):
-    for substring in substrings:
-        if substring.startswith('*') and substring.endswith('*'):
-            substring = substring.replace('*', '') # Remove '*' and perform fuzzy matching
-            if substring in s:
-                return True
-        elif substring.startswith('*'):
-            substring = substring.replace('*', '') + '$' # Replace '*' with empty and add '$' at the end to indicate the end of the string
-            if re.search(substring, s):
-                return True
-        elif substring.endswith('*'):
-            substring = '^' + substring.replace('*', '') # Replace '*' with empty and add '^' at the beginning to indicate the start of the string
-            if re.search(substring, s):
-                return True
-        else:  # If the substring does not contain '*', perform full word matching
-            if substring == s:
-                return True
-    return False
-
-
-def initDB(db_path: str = "db.sqlite3"):
-    db = apsw.Connection(db_path)
-    cursor = db.cursor()
-
-    # Create pictures table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS pictures (
-    picture_id INTEGER PRIMARY KEY,
-    id INTEGER NOT NULL,
-    author_id INTEGER NOT NULL,
-    author_name TEXT NOT NULL,
-    title TEXT NOT NULL,
-    page_no INTEGER NOT NULL,
-    page_count INTEGER NOT NULL,
-    orientation TINYINT NOT NULL,
-    r18 TINYINT NOT NULL,
-    ai_type TINYINT NOT NULL,
-    url TEXT NOT NULL,
-    local_filename TEXT NOT NULL DEFAULT '',
-    local_filename_compressed TEXT NOT NULL DEFAULT ''
-    );''')
-
-    # Create indices for pictures table
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_author_name ON pictures(author_name);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_orientation ON pictures(orientation);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_r18 ON pictures(r18);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_ai_type ON pictures(ai_type);')
-
-    # Create tags table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS tags (
-    tag_id INTEGER PRIMARY KEY,
-    name TEXT UNIQUE NOT NULL,
-    translated_name TEXT UNIQUE
-    );''')
-
-    # Create tags_fts table and triggers
-    cursor.execute('''
-    CREATE VIRTUAL TABLE IF NOT EXISTS tags_fts USING FTS5(name, translated_name, content="tags", content_rowid="tag_id", tokenize='unicode61');
-    ''')
-    # Create triggers for insert, delete and update operations
-    # Trigger for insert operation
-    cursor.execute('''
-    CREATE TRIGGER IF NOT EXISTS tags_ai AFTER INSERT ON tags BEGIN
-        INSERT INTO tags_fts(rowid, name, translated_name) VALUES (new.tag_id, new.name, new.translated_name);
-    END;
-    ''')
-    # Trigger for delete operation
-    cursor.execute('''
-    CREATE TRIGGER IF NOT EXISTS tags_ad AFTER DELETE ON tags BEGIN
-        INSERT INTO tags_fts(tags_fts, rowid, name, translated_name) VALUES('delete', old.tag_id, old.name, old.translated_name);
-    END;
-    ''')
-    # Trigger for update operation
-    cursor.execute('''
-    CREATE TRIGGER IF NOT EXISTS tags_au AFTER UPDATE ON tags BEGIN
-        INSERT INTO tags_fts(tags_fts, rowid, name, translated_name) VALUES('delete', old.tag_id, old.name, old.translated_name);
-        INSERT INTO tags_fts(rowid, name, translated_name) VALUES (new.tag_id, new.name, new.translated_name);
-    END;
-    ''')
-
-    # Create picture_tags table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS picture_tags (
-    picture_id INTEGER REFERENCES pictures(picture_id) ON DELETE CASCADE ON UPDATE CASCADE,
-    tag_id INTEGER REFERENCES tags(tag_id) ON DELETE CASCADE ON UPDATE CASCADE,
-    PRIMARY KEY (picture_id, tag_id)
-    );''')
-
-    # Create indices for picture_tags table
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_picture_tags_picture_id ON picture_tags(picture_id);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS index_picture_tags_tag_id ON picture_tags(tag_id);')
-
-    # commit by apsw
-
-    return db
-
-
 def lenDB():
-    global db
-    cursor = db.cursor()
+    cursor = get_read_connection(db_path).cursor()
     cursor.execute("SELECT COUNT(*) FROM pictures")
     return cursor.fetchone()[0]
 
 
 def insertDB(pk, data, force_update=False):
-    global db
+    return insertManyDB([(pk, data)], force_update)[0]
+
+
+def insertManyDB(items, force_update=False, connection=None):
+    # insert a batch of (pk, data) items in a single transaction, returns a list of booleans telling whether each item was inserted
+    connection = connection or db
+    results = [False] * len(items)
+    if not items:
+        return results
     # convert pk into xxhash integer
-    pk = xxhash.xxh32_intdigest(pk)
-    try:
-        # create a cursor object
-        cursor = db.cursor()
-        # check if force_update is True
-        if force_update:
-            # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-            cursor.execute("INSERT OR REPLACE INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url, local_filename, local_filename_compressed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT local_filename_compressed FROM pictures WHERE picture_id = ?))", ((
-                pk), data["id"], data["author_id"], data["author_name"], data["title"], data["page_no"], data["page_count"], data["orientation"], data["r18"], data["ai_type"], data["url"], data["local_filename"], pk))
-            # commit changes
-            # commit by apsw
-            # insert tags
-            for tag in data["tags"]:
-                # calculate tag_id by hashing tag name
-                tag_id = xxhash.xxh32_intdigest(str(tag["name"]))
-                # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-                cursor.execute("INSERT OR REPLACE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)", ((tag_id, tag["name"], tag["translated_name"])))
-                # commit changes
-                # commit by apsw
-                # use the INSERT OR REPLACE statement to proform 'UPSERT' operation
-                cursor.execute(
-                    "INSERT OR REPLACE INTO picture_tags (picture_id, tag_id) VALUES (?, (SELECT tag_id FROM tags WHERE name = ?))", ((pk), tag["name"]))
-                # commit changes
-                # commit by apsw
-        else:
-            # use the INSERT statement to insert data only if it does not exist
-            cursor.execute("INSERT INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url, local_filename) VALUES (?, ?, ?, ?, ?, ?, ?, ? , ? , ? , ? , ?)", ((
-                pk), data["id"], data["author_id"], data["author_name"], data["title"], data["page_no"], data["page_count"], data["orientation"], data["r18"], data["ai_type"], data["url"], data["local_filename"]))
-            # commit changes
-            # commit by apsw
-            # insert tags
-            for tag in data["tags"]:
-                # calculate tag_id by hashing tag name
-                tag_id = xxhash.xxh32_intdigest(str(tag["name"]))
-                # use the INSERT OR IGNORE statement to insert data only if it does not exist
-                cursor.execute("INSERT OR IGNORE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)", ((tag_id, tag["name"], tag["translated_name"])))
-                # commit changes
-                # commit by apsw
-                # use the INSERT OR IGNORE statement to insert data only if it does not exist
-                cursor.execute(
-                    "INSERT OR IGNORE INTO picture_tags (picture_id, tag_id) VALUES (?, (SELECT tag_id FROM tags WHERE name = ?))", ((pk), tag["name"]))
-                # commit changes
-                # commit by apsw
-        return True
-    except apsw.ConstraintError as e:
-        if force_update:
-            logger.warning(
-                "Aborting database insertion for picture_id: " + str(pk) + " due to error: " + str(e))
-        return False
-    except Exception as e:
-        logger.error("Aborting database insertion for picture_id: " + str(pk) + " due to error: " +
-              str(e) + "\n" + traceback.format_exc())
-        return False
+    pks = [xxhash.xxh32_intdigest(pk) for pk, _ in items]
+    # apsw connections cannot be used by several threads at once, crawl threads write one batch at a time
+    with db_lock, pixiv_metrics.insert_seconds.time():
+        try:
+            # create a cursor object
+            cursor = connection.cursor()
+            try:
+                # everything below is committed (or rolled back) at once by apsw
+                with connection:
+                    rows, results, new_pks, tags = write_pictures(
+                        cursor, pks, items, force_update)
+            except Exception as e:
+                # one bad item (e.g. a missing field or a NULL name) rolls back the whole batch, so items are written again one by one
+                # each in a savepoint of the same transaction, only the bad ones are skipped
+                logger.warning("Batch insertion failed due to error: " + str(e) + ", inserting picture_ids one by one")
+                rows, results, new_pks, tags = [], [], [], []
+                with connection:
+                    for pk, item in zip(pks, items):
+                        try:
+                            with connection:
+                                item_rows, item_results, item_new_pks, item_tags = write_pictures(
+                                    cursor, [pk], [item], force_update)
+                        except Exception as e:
+                            logger.warning("Skipping database insertion for picture_id: " +
+                                           str(pk) + " due to error: " + str(e))
+                            item_rows, item_results, item_new_pks, item_tags = [], [False], [], []
+                        rows += item_rows
+                        results += item_results
+                        new_pks += item_new_pks
+                        tags += item_tags
+            if force_update:
+                # tag names may have been replaced
+                invalidate_tag_cache([xxhash.xxh32_intdigest(str(tag["name"])) for tag in tags])
+            if connection is db:
+                # keep the in-memory index in sync, the last occurrence of a picture_id in the batch wins
+                index_rows = dict((pk, (pk, data["id"], data["author_id"], data["r18"], data["orientation"], data["ai_type"])) for pk, data in rows)
+                add_picture_index([index_rows.pop(pk) for pk in new_pks if pk in index_rows])
+                update_picture_index(list(index_rows.values()))
+            if rows:
+                bump_generation()
+            pixiv_metrics.insert_rows.inc("inserted", amount=len(rows))
+            pixiv_metrics.insert_rows.inc("skipped", amount=len(items) - len(rows))
+            return results
+        except Exception as e:
+            logger.error("Aborting database insertion for picture_ids: " + str(pks) + " due to error: " +
+                  str(e) + "\n" + traceback.format_exc())
+            return [False] * len(items)
 
 
-def cursor_to_dict(cursor: apsw.Cursor, query: str):
-    cursor.execute(query)
-    rows = cursor.fetchone()
-    if rows:
-        columns = [desc[0] for desc in cursor.getdescription()]
-        rows = [rows] + cursor.fetchall()
-        return [dict(zip(columns, row)) for row in rows]
-    return []
+def write_pictures(cursor, pks, items, force_update=False):
+    # write pictures, tags and picture_tags of (pk, data) items in the current transaction of cursor
+    # returns (written (pk, data) rows, inserted flag per item, picture_ids new to the table, tags of written rows)
+    results = [False] * len(items)
+    # look up which picture_ids already exist
+    cursor.execute("SELECT picture_id FROM pictures WHERE picture_id IN ({})".format(
+        ", ".join("?" * len(pks))), pks)
+    existing_pks = set(row[0] for row in cursor.fetchall())
+    new_pks = []
+    for pk in pks:
+        if pk not in existing_pks:
+            existing_pks.add(pk)
+            new_pks.append(pk)
+    if force_update:
+        # every item is upserted
+        rows = [(pk, data) for pk, (_, data) in zip(pks, items)]
+        results = [True] * len(items)
+        # use the INSERT OR REPLACE statement to proform 'UPSERT' operation, keeping local_filename_compressed unless it is given
+        cursor.executemany("INSERT OR REPLACE INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url, local_filename, local_filename_compressed, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT local_filename_compressed FROM pictures WHERE picture_id = ?)), ?, ?)", [(
+            pk, data["id"], data["author_id"], data["author_name"], data["title"], data["page_no"], data["page_count"], data["orientation"], data["r18"], data["ai_type"], data["url"], data["local_filename"], data.get("local_filename_compressed"), pk, data.get("width"), data.get("height")) for pk, data in rows])
+        tag_statement = "INSERT OR REPLACE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)"
+        picture_tag_statement = "INSERT OR REPLACE INTO picture_tags (picture_id, tag_id) VALUES (?, (SELECT tag_id FROM tags WHERE name = ?))"
+    else:
+        # only insert items whose picture_id does not exist yet (neither in the database nor earlier in this batch)
+        rows = []
+        remaining_pks = set(new_pks)
+        for i, (pk, (_, data)) in enumerate(zip(pks, items)):
+            if pk not in remaining_pks:
+                continue
+            remaining_pks.remove(pk)
+            rows.append((pk, data))
+            results[i] = True
+        # use the INSERT statement to insert data only if it does not exist
+        if rows:
+            cursor.executemany("INSERT INTO pictures (picture_id, id, author_id, author_name, title, page_no, page_count, orientation, r18, ai_type, url, local_filename, local_filename_compressed, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(
+                pk, data["id"], data["author_id"], data["author_name"], data["title"], data["page_no"], data["page_count"], data["orientation"], data["r18"], data["ai_type"], data["url"], data["local_filename"], data.get("local_filename_compressed") or "", data.get("width"), data.get("height")) for pk, data in rows])
+        tag_statement = "INSERT OR IGNORE INTO tags (tag_id, name, translated_name) VALUES (?, ?, ?)"
+        picture_tag_statement = "INSERT OR IGNORE INTO picture_tags (picture_id, tag_id) VALUES (?, (SELECT tag_id FROM tags WHERE name = ?))"
+    # insert tags, tag_id is calculated by hashing tag name
+    tags = [tag for _, data in rows for tag in data["tags"]]
+    if tags:
+        cursor.executemany(tag_statement, [(xxhash.xxh32_intdigest(
+            str(tag["name"])), tag["name"], tag["translated_name"]) for tag in tags])
+        cursor.executemany(picture_tag_statement, [
+                           (pk, tag["name"]) for pk, data in rows for tag in data["tags"]])
+    return rows, results, new_pks, tags
 
 
 def get_list(string: str):
@@ -217,7 +170,7 @@ def get_list(string: str):
 
 
 def read_config():
-    global api, config, db_path, store_mode, download_folder, download_quality, download_reverse_proxy, ranking_modes, get_all_ranking_pages, allow_multiple_pages, get_all_multiple_pages, update_interval, crawler_status, last_update_timestamp, excluding_tags, stop_compression_task, max_rate_limit_retries
+    global config, db_path, store_mode, download_folder, download_quality, download_threads, content_addressed_storage, download_reverse_proxy, ranking_modes, get_all_ranking_pages, stop_at_known_page, allow_multiple_pages, get_all_multiple_pages, update_interval, verify_interval, crawler_status, last_update_timestamp, excluding_tags, stop_compression_task, max_rate_limit_retries, crawl_threads, max_requests_per_minute, max_request_burst, max_downloads_per_minute, compress_processes, api_host, max_connections_per_host, api_rate_limiter, download_rate_limiter
     crawler_status = "reloading config"
     # read config file
     config = configupdater.ConfigUpdater()
@@ -274,6 +227,34 @@ def read_config():
     config.set("Crawler", "download_quality", download_quality)
     if comment != "":
         config["Crawler"]["download_quality"].add_before.comment(comment)
+    # get download_threads (default: 4)
+    comment = ""
+    if config.has_option("Crawler", "download_threads") and config["Crawler"]["download_threads"].value.isdigit() and int(config["Crawler"]["download_threads"].value) >= 1:
+        download_threads = int(config["Crawler"]["download_threads"].value)
+    else:
+        if not config.has_option("Crawler", "download_threads"):
+            comment = (
+                "number of concurrent download workers when store_mode is full (at least 1)")
+        download_threads = 4
+        logger.warning(
+            "download_threads invalid, using default: " + str(download_threads))
+    config.set("Crawler", "download_threads", str(download_threads))
+    if comment != "":
+        config["Crawler"]["download_threads"].add_before.comment(comment)
+    # get content_addressed_storage flag (default: False)
+    comment = ""
+    if config.has_option("Crawler", "content_addressed_storage"):
+        content_addressed_storage = bool(
+            config["Crawler"]["content_addressed_storage"].value.capitalize() == "True")
+    else:
+        comment = (
+            "True(name downloaded images by their content hash in sharded sub folders, identical images are stored once), False(name downloaded images by illustration id, author and title)")
+        content_addressed_storage = False
+        logger.warning("content_addressed_storage invalid, using default: " +
+                       str(content_addressed_storage))
+    config.set("Crawler", "content_addressed_storage", content_addressed_storage)
+    if comment != "":
+        config["Crawler"]["content_addressed_storage"].add_before.comment(comment)
     # get download reverse proxy (default: i.pixiv.re)
     comment = ""
     if config.has_option("Crawler", "download_reverse_proxy"):
@@ -330,6 +311,20 @@ def read_config():
     config.set("Crawler", "get_all_ranking_pages", str(get_all_ranking_pages))
     if comment != "":
         config["Crawler"]["get_all_ranking_pages"].add_before.comment(comment)
+    # get stop_at_known_page flag (default: False)
+    comment = ""
+    if config.has_option("Crawler", "stop_at_known_page"):
+        stop_at_known_page = bool(
+            config["Crawler"]["stop_at_known_page"].value.capitalize() == "True")
+    else:
+        comment = (
+            "True(stop getting ranking pages once a whole page is already in database, not applied to force update), False(always get all ranking pages)")
+        stop_at_known_page = False
+        logger.warning("stop_at_known_page invalid, using default: " +
+                       str(stop_at_known_page))
+    config.set("Crawler", "stop_at_known_page", stop_at_known_page)
+    if comment != "":
+        config["Crawler"]["stop_at_known_page"].add_before.comment(comment)
     # get allow_multiple_pages flag (default: False)
     comment = ""
     if config.has_option("Crawler", "allow_multiple_pages"):
@@ -372,6 +367,20 @@ def read_config():
     config.set("Crawler", "update_interval", str(update_interval))
     if comment != "":
         config["Crawler"]["update_interval"].add_before.comment(comment)
+    # get verify_interval
+    comment = ""
+    if config.has_option("Crawler", "verify_interval") and config["Crawler"]["verify_interval"].value.isdigit():
+        verify_interval = int(config["Crawler"]["verify_interval"].value)
+    else:
+        if (not config.has_option("Crawler", "verify_interval")):
+            comment = (
+                "minimum interval (seconds) between each background check of local images when user is calling /api/v1/img, broken images are removed (set to 0 to disable)")
+        verify_interval = 86400
+        logger.warning(
+            "verify_interval invalid, using default: " + str(verify_interval))
+    config.set("Crawler", "verify_interval", str(verify_interval))
+    if comment != "":
+        config["Crawler"]["verify_interval"].add_before.comment(comment)
     # get max_rate_limit_retries
     comment = ""
     if config.has_option("Crawler", "max_rate_limit_retries") and int(config["Crawler"]["max_rate_limit_retries"].value) >= 0:
@@ -380,13 +389,121 @@ def read_config():
     else:
         if (not config.has_option("Crawler", "max_rate_limit_retries")):
             comment = (
-                "maximum number of retries when encountering rate limit, each retry will pause for 30 seconds")
+                "maximum number of retries when encountering rate limit, retries pause with an exponential backoff starting at 30 seconds")
         max_rate_limit_retries = 5
         logger.warning("max_rate_limit_retries invalid, using default: " +
                        str(max_rate_limit_retries))
     config.set("Crawler", "max_rate_limit_retries", str(max_rate_limit_retries))
     if comment != "":
         config["Crawler"]["max_rate_limit_retries"].add_before.comment(comment)
+    # get crawl_threads
+    comment = ""
+    if config.has_option("Crawler", "crawl_threads") and config["Crawler"]["crawl_threads"].value.isdigit() and int(config["Crawler"]["crawl_threads"].value) >= 1:
+        crawl_threads = int(config["Crawler"]["crawl_threads"].value)
+    else:
+        if (not config.has_option("Crawler", "crawl_threads")):
+            comment = (
+                "number of rankings (date and mode) crawled concurrently, e.g. when crawling from past dates (at least 1)")
+        crawl_threads = 4
+        logger.warning("crawl_threads invalid, using default: " +
+                       str(crawl_threads))
+    config.set("Crawler", "crawl_threads", str(crawl_threads))
+    if comment != "":
+        config["Crawler"]["crawl_threads"].add_before.comment(comment)
+    # get max_requests_per_minute
+    comment = ""
+    if config.has_option("Crawler", "max_requests_per_minute") and config["Crawler"]["max_requests_per_minute"].value.isdigit():
+        max_requests_per_minute = int(
+            config["Crawler"]["max_requests_per_minute"].value)
+    else:
+        if (not config.has_option("Crawler", "max_requests_per_minute")):
+            comment = (
+                "maximum number of Pixiv API requests per minute shared by all crawl threads (set to 0 to disable the limit)")
+        max_requests_per_minute = 60
+        logger.warning("max_requests_per_minute invalid, using default: " +
+                       str(max_requests_per_minute))
+    config.set("Crawler", "max_requests_per_minute", str(max_requests_per_minute))
+    if comment != "":
+        config["Crawler"]["max_requests_per_minute"].add_before.comment(comment)
+    # get max_request_burst
+    comment = ""
+    if config.has_option("Crawler", "max_request_burst") and config["Crawler"]["max_request_burst"].value.isdigit() and int(config["Crawler"]["max_request_burst"].value) >= 1:
+        max_request_burst = int(
+            config["Crawler"]["max_request_burst"].value)
+    else:
+        if (not config.has_option("Crawler", "max_request_burst")):
+            comment = (
+                "maximum number of Pixiv API requests that could be sent at once before max_requests_per_minute applies (at least 1)")
+        max_request_burst = 5
+        logger.warning("max_request_burst invalid, using default: " +
+                       str(max_request_burst))
+    config.set("Crawler", "max_request_burst", str(max_request_burst))
+    if comment != "":
+        config["Crawler"]["max_request_burst"].add_before.comment(comment)
+    # get max_downloads_per_minute
+    comment = ""
+    if config.has_option("Crawler", "max_downloads_per_minute") and config["Crawler"]["max_downloads_per_minute"].value.isdigit():
+        max_downloads_per_minute = int(
+            config["Crawler"]["max_downloads_per_minute"].value)
+    else:
+        if (not config.has_option("Crawler", "max_downloads_per_minute")):
+            comment = (
+                "maximum number of image downloads per minute shared by all download workers (set to 0 to disable the limit)")
+        max_downloads_per_minute = 0
+        logger.warning("max_downloads_per_minute invalid, using default: " +
+                       str(max_downloads_per_minute))
+    config.set("Crawler", "max_downloads_per_minute", str(max_downloads_per_minute))
+    if comment != "":
+        config["Crawler"]["max_downloads_per_minute"].add_before.comment(comment)
+    # get compress_processes (default: 0, one process per CPU core)
+    comment = ""
+    if config.has_option("Crawler", "compress_processes") and config["Crawler"]["compress_processes"].value.isdigit():
+        compress_processes = int(
+            config["Crawler"]["compress_processes"].value)
+    else:
+        if (not config.has_option("Crawler", "compress_processes")):
+            comment = (
+                "number of worker processes used by image compression (set to 0 to use one process per CPU core)")
+        compress_processes = 0
+        logger.warning("compress_processes invalid, using default: " +
+                       str(compress_processes))
+    config.set("Crawler", "compress_processes", str(compress_processes))
+    if comment != "":
+        config["Crawler"]["compress_processes"].add_before.comment(comment)
+    # get api_host (default: empty, the Pixiv app API)
+    comment = ""
+    if config.has_option("Crawler", "api_host"):
+        api_host = config["Crawler"]["api_host"].value.rstrip("/")
+    else:
+        comment = (
+            "host of the Pixiv app API (leave empty to crawl from Pixiv), e.g. http://127.0.0.1:8001 to crawl from a local pixiv_fake_service without logging in")
+        api_host = ""
+        logger.warning("api_host invalid, using default: " + api_host)
+    config.set("Crawler", "api_host", api_host)
+    if comment != "":
+        config["Crawler"]["api_host"].add_before.comment(comment)
+    # get max_connections_per_host (default: 0, no limit)
+    comment = ""
+    if config.has_option("Crawler", "max_connections_per_host") and config["Crawler"]["max_connections_per_host"].value.isdigit():
+        max_connections_per_host = int(
+            config["Crawler"]["max_connections_per_host"].value)
+    else:
+        if (not config.has_option("Crawler", "max_connections_per_host")):
+            comment = (
+                "maximum number of connections opened to each host at once, requests wait for a free connection above it (set to 0 to keep download_threads + crawl_threads connections per host alive without limiting them)")
+        max_connections_per_host = 0
+        logger.warning("max_connections_per_host invalid, using default: " +
+                       str(max_connections_per_host))
+    config.set("Crawler", "max_connections_per_host", str(max_connections_per_host))
+    if comment != "":
+        config["Crawler"]["max_connections_per_host"].add_before.comment(comment)
+    # keep-alive pools of the shared HTTP transport are sized to the number of threads sending requests at once
+    pixiv_http.configure(get_proxy(), download_threads + crawl_threads, max_connections_per_host)
+    # init rate limiters, the rate adapts to rate limit responses of Pixiv
+    api_rate_limiter = RateLimiter(
+        max_requests_per_minute, max_request_burst, name="api")
+    download_rate_limiter = RateLimiter(
+        max_downloads_per_minute, download_threads, name="download")
     # reset stop_compression_task flag (default: False)
     stop_compression_task = False
 
@@ -395,15 +512,13 @@ def read_config():
         config.write(configfile)
 
     last_update_timestamp = -1
-    auth_api(True)
     logger.info("Crawler config loaded")
     crawler_status = "idle"
 
 
-def auth_api(log_info=False):
-    global api
-    # init api
-    refreshtoken = get_refresh_token(log_info=log_info)
+def create_api_client(log_info=False):
+    # default api_client_factory: AppPixivAPI logged in with the refresh token (through the configured proxy)
+    # with api_host set, the client talks to that host instead and does not log in
     proxy = get_proxy()
     REQUESTS_KWARGS = {
         'proxies': {
@@ -411,8 +526,24 @@ def auth_api(log_info=False):
             'http': proxy
         }
     }
-    api = AppPixivAPI(**REQUESTS_KWARGS)
-    api.auth(refresh_token=refreshtoken)
+    client = AppPixivAPI(**REQUESTS_KWARGS)
+    # API calls and downloads go through the pooled adapters of the shared transport
+    # an api_host is reached directly, without the proxy
+    pixiv_http.mount(client.requests, use_proxy=not api_host)
+    if api_host:
+        client.hosts = api_host
+        client.requests_kwargs = {}
+        client.set_auth("offline", "offline")
+        return client
+    refreshtoken = get_refresh_token(log_info=log_info)
+    client.auth(refresh_token=refreshtoken)
+    return client
+
+
+def auth_api(log_info=False):
+    global api
+    # init api through the pluggable factory, e.g. replaced by tests or benchmarks with a client of their own
+    api = api_client_factory(log_info)
     if log_info:
         user_detail = api.user_detail(api.user_id)
         try:
@@ -424,15 +555,13 @@ def auth_api(log_info=False):
 
 
 def get_crawler_status():
+    if crawler_status.startswith("crawling"):
+        api_state = api_rate_limiter.get_state()
+        download_state = download_rate_limiter.get_state()
+        return crawler_status + " (API rate {}/{} requests per minute{}, {} rate limits hit; {} downloads{})".format(api_state["rate_per_minute"], api_state["max_rate_per_minute"] or "unlimited", ", backing off for {}s".format(api_state["backoff_seconds"]) if api_state["backoff_seconds"] else "", api_state["rate_limit_hits"], download_state["requests"], ", backing off for {}s".format(download_state["backoff_seconds"]) if download_state["backoff_seconds"] else "")
     return crawler_status
 
 
-def compress_image(image_path, output_path, quality):
-    image = Image.open(image_path)
-    image = image.convert('RGB')
-    image.save(output_path, optimize=True, quality=quality)
-
-
 def get_image_orientation(width, height):
     if width > height:
         return 0 # 'Landscape'
@@ -442,43 +571,380 @@ def get_image_orientation(width, height):
         return 2 # 'Square'
 
 
-def get_image_orientation_from_source(source):
-    p = ImageFile.Parser()
+def get_image_orientation_from_source(source, session=None):
+    # only the header of the image is read (through session if given, so that connections are reused)
+    return get_image_orientation(*get_image_size(source, session))
+
 
-    # Check if the source is a URL or a local file
-    if source.startswith('http://') or source.startswith('https://'):
-        # Request image data
-        response = requests.get(source, stream=True)
+def get_extension(filename):
+    return os.path.splitext(filename)[1]
+
+
+def download_image(url, filename, referer="https://app-api.pixiv.net/"):
+    # like api.download (same session and Referer), but error responses raise instead of being saved as the image
+    # so that the download rate limiter sees HTTP 429 responses of the image host
+    with api.requests_call("GET", url, headers={"Referer": referer}, stream=True) as response:
         response.raise_for_status()
+        with open(filename, "wb") as file:
+            shutil.copyfileobj(response.raw, file)
+    return True
+
 
-        # Try to read only the first 1024 bytes of data to get the image size
-        for chunk in response.iter_content(chunk_size=1024):
-            if not chunk:
-                break
-            p.feed(chunk)
-            if p.image:
-                return get_image_orientation(*p.image.size)
-
-        # If the first 1024 bytes are not enough to determine the image size,
-        # then we need to read the whole image
-        with Image.open(response.raw) as img:
-            return get_image_orientation(*img.size)
+def download_worker(download_queue: queue.Queue, download_stats: dict):
+    # drain (download_url, local_filename, pk, checkpoint, page) items until a None sentinel is received
+    # an empty local_filename means the image goes to the content-addressed store and the picture is pointed at it afterwards
+    # checkpoint (a UnitCheckpoint or None) is told when the download of its page is done, whether it succeeded or not
+    while True:
+        item = download_queue.get()
+        if item is None:
+            download_queue.task_done()
+            break
+        download_url, local_filename, pk, checkpoint, page = item
+        start_time = time.time()
+        try:
+            if local_filename:
+                downloaded = False
+                if not os.path.exists(local_filename):
+                    # written under a temporary name, so that an existing local_filename is always a complete image
+                    partial_filename = local_filename + ".part"
+                    downloaded = download_rate_limiter.call(
+                        download_image, download_url, partial_filename, max_retries=max_rate_limit_retries)
+                    if downloaded:
+                        os.replace(partial_filename, local_filename)
+                        record_local_file(local_filename)
+                        pixiv_metrics.download_bytes.inc(
+                            amount=os.path.getsize(local_filename))
+                if os.path.exists(local_filename):
+                    # pictures are inserted without their file until it is written, so that readers and the verifier never take a pending download for a missing file
+                    with db_lock:
+                        db.cursor().execute("UPDATE pictures SET local_filename = ? WHERE picture_id = ? AND local_filename != ?",
+                                            (local_filename, xxhash.xxh32_intdigest(pk), local_filename))
+                        changed = db.changes() > 0
+                    if changed:
+                        bump_generation()
+            else:
+                incoming_folder = os.path.join(download_folder, "incoming")
+                if not os.path.exists(incoming_folder):
+                    os.makedirs(incoming_folder)
+                incoming_filename = os.path.join(incoming_folder, pk + get_extension(download_url))
+                downloaded = download_rate_limiter.call(
+                    download_image, download_url, incoming_filename, max_retries=max_rate_limit_retries)
+                if downloaded:
+                    pixiv_metrics.download_bytes.inc(
+                        amount=os.path.getsize(incoming_filename))
+                    local_filename = store_content_addressed(incoming_filename)
+                    record_local_file(local_filename)
+                    with db_lock:
+                        db.cursor().execute("UPDATE pictures SET local_filename = ? WHERE picture_id = ?",
+                                            (local_filename, xxhash.xxh32_intdigest(pk)))
+                    bump_generation()
+        except RateLimitException:
+            downloaded = False
+            logger.error("Failed to download '" + download_url + "' due to error: rate limit retries of " +
+                         str(max_rate_limit_retries) + "/" + str(max_rate_limit_retries) + " reached")
+        except Exception as e:
+            downloaded = False
+            logger.error("Failed to download '" + download_url + "' due to error: " +
+                         str(e) + "\n" + traceback.format_exc())
+        pixiv_metrics.download_seconds.observe(
+            time.time() - start_time, "downloaded" if downloaded else "skipped")
+        with download_stats["lock"]:
+            download_stats["seconds"] += time.time() - start_time
+            if downloaded:
+                download_stats["count"] += 1
+        if checkpoint:
+            checkpoint.download_done(page)
+        download_queue.task_done()
+
+
+def store_content_addressed(filename):
+    # move a downloaded file into the content-addressed store, sharded by its xxhash (download_folder/ab/cd/abcd....ext), returns its new path
+    digest = xxhash.xxh3_128()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    folder = os.path.join(download_folder, digest[:2], digest[2:4])
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    stored_filename = os.path.normpath(os.path.join(folder, digest + get_extension(filename)))
+    if os.path.exists(stored_filename):
+        # same content is already stored
+        os.remove(filename)
     else:
-        with open(source, 'rb') as f:
-            # Read only the first 1024 bytes of the file
-            data = f.read(1024)
-            p.feed(data)
+        os.replace(filename, stored_filename)
+    return stored_filename
 
-            if p.image:
-                return get_image_orientation(*p.image.size)
 
-        # If the first 1024 bytes are not enough to determine the image size, then we need to read the whole image
-        with Image.open(source) as img:
-            return get_image_orientation(*img.size)
+def get_stored_files(urls):
+    # existing local files of pictures with these urls, returns {url: local_filename}
+    if not urls:
+        return {}
+    with db_lock:
+        rows = db.cursor().execute("SELECT url, local_filename FROM pictures WHERE local_filename != '' AND url IN ({})".format(
+            ", ".join("?" * len(urls))), urls).fetchall()
+    return dict((url, local_filename) for url, local_filename in rows if os.path.exists(local_filename))
 
 
-def get_extension(filename):
-    return os.path.splitext(filename)[1]
+def record_local_file(filename):
+    # remember size and modification time of a local image known to be valid, so that serving it only needs an os.stat
+    stat = os.stat(filename)
+    with db_lock:
+        db.cursor().execute("INSERT OR REPLACE INTO local_files (filename, size, mtime, verified_timestamp) VALUES (?, ?, ?, ?)",
+                            (filename, stat.st_size, stat.st_mtime, time.time()))
+
+
+def check_local_file(filename, cursor=None):
+    # fast check of a local image: it exists, is not empty and is unchanged since it was recorded
+    # returns True (valid), False (missing or empty) or None (changed or never recorded, needs to be verified)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return False
+    if stat.st_size == 0:
+        return False
+    row = (cursor or get_read_connection(db_path).cursor()).execute(
+        "SELECT size, mtime FROM local_files WHERE filename = ?", (filename,)).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        return True
+    return None
+
+
+def verify_local_file(filename):
+    # full check of a local image (header and structure parsed by Pillow), recorded if valid
+    try:
+        with Image.open(filename) as image:
+            image.verify()
+    except Exception:
+        return False
+    record_local_file(filename)
+    return True
+
+
+def get_orphan_picture(filename):
+    # picture (pk, compressed) a file could belong to, judging from the file name given by the crawler (id_author_title_pN[_compressed].ext)
+    match = re.match(r"^(\d+)_.*_p(\d+)(_compressed)?\.\w+$", os.path.basename(filename))
+    if not match:
+        return None, False
+    return match.group(1) + "_" + match.group(2), bool(match.group(3))
+
+
+def normalize_path(filename):
+    # comparable form of a local path: the same file gives the same string whether it was stored relative or absolute, or with redundant separators
+    return os.path.normcase(os.path.abspath(filename))
+
+
+def get_stored_references(cursor):
+    # normalized paths of every file a picture (or derivative) refers to
+    references = set()
+    for (filename,) in cursor.execute("SELECT local_filename FROM pictures WHERE local_filename != '' UNION ALL SELECT local_filename_compressed FROM pictures WHERE local_filename_compressed != '' UNION ALL SELECT filename FROM derivatives"):
+        references.add(normalize_path(filename))
+    return references
+
+
+def scan_orphan_files(orphans: str, report: dict):
+    # walk download_folder for files no picture (nor derivative) refers to, orphans are reported, deleted or adopted by the picture they were downloaded for
+    # stored paths and walked paths are compared normalized, nothing is deleted or adopted if no walked file matches a stored one (e.g. a download_folder moved elsewhere)
+    cursor = get_read_connection(db_path).cursor()
+    references = get_stored_references(cursor)
+    incoming_folder = normalize_path(os.path.join(download_folder, "incoming"))
+    matched = 0
+    orphan_files = []
+    for folder, folders, filenames in os.walk(download_folder):
+        if normalize_path(folder) == incoming_folder:
+            # downloads in progress
+            folders.clear()
+            continue
+        for filename in filenames:
+            filename = os.path.join(folder, filename)
+            if stop_verify_task:
+                return
+            report["files"] += 1
+            if time.time() - os.path.getmtime(filename) < 600:
+                # recently written files may belong to a download that is not in the database yet
+                continue
+            if normalize_path(filename) in references:
+                matched += 1
+                continue
+            report["orphans"] += 1
+            orphan_files.append(filename)
+    if orphans not in ["delete", "adopt"] or not orphan_files:
+        return
+    if not matched:
+        logger.warning("None of the {} files in '{}' is referred to by the database, keeping the orphan files".format(
+            report["files"], download_folder))
+        return
+    for filename in orphan_files:
+        if stop_verify_task:
+            return
+        if cursor.execute("SELECT EXISTS(SELECT 1 FROM pictures WHERE local_filename = ?) OR EXISTS(SELECT 1 FROM pictures WHERE local_filename_compressed = ?)", (filename, filename)).fetchone()[0]:
+            # referred to since the walk started
+            continue
+        if orphans == "adopt":
+            pk, compressed = get_orphan_picture(filename)
+            picture_id = xxhash.xxh32_intdigest(pk) if pk else None
+            row = cursor.execute("SELECT local_filename, local_filename_compressed FROM pictures WHERE picture_id = ?", (picture_id,)).fetchone() if pk else None
+            # only pictures whose own file is gone adopt an orphan
+            if row and not os.path.exists(row[1 if compressed else 0]) and verify_local_file(filename):
+                with db_lock:
+                    db.cursor().execute("UPDATE pictures SET {} = ? WHERE picture_id = ?".format(
+                        "local_filename_compressed" if compressed else "local_filename"), (filename, picture_id))
+                bump_generation()
+                report["orphans_adopted"] += 1
+                continue
+        logger.info("Removing orphan file '{}'".format(filename))
+        os.remove(filename)
+        report["orphans_deleted"] += 1
+
+
+def get_verify_report():
+    return dict(verify_report)
+
+
+def is_verify_due():
+    # whether the background verification interval has passed, from the timestamp kept in memory, so that it can be checked on every request without the writer connection
+    return verify_interval != 0 and time.time() - last_verify_timestamp >= verify_interval
+
+
+def verify_local_files(manual=False, full_decode: bool = False, orphans: str = "report"):
+    # reconcile local images with the database: every local image is checked on a process pool (only the ones changed since they were recorded, or all with full_decode),
+    # broken and missing ones are removed through remove_local_file, while download_folder is walked for orphan files in parallel
+    # orphans is one of report, delete, adopt, the database walk is checkpointed and resumed if interrupted with the same settings
+    global verifier_running, verify_report, stop_verify_task, last_verify_timestamp
+    if not manual and not is_verify_due():
+        return
+    with verifier_lock:
+        if verifier_running:
+            return
+        verifier_running = True
+    stop_verify_task = False
+    checkpoint = json.loads(get_crawler_state("verify_local_files", "{}"))
+    after = checkpoint["picture_id"] if checkpoint.get(
+        "full_decode") == full_decode else None
+    processes = compress_processes or os.cpu_count() or 1
+    report = {"running": True, "full_decode": full_decode, "orphans_mode": orphans, "pictures": 0, "checked": 0, "valid": 0, "broken": 0, "missing": 0,
+              "files": 0, "orphans": 0, "orphans_deleted": 0, "orphans_adopted": 0, "seconds": 0, "images_per_second": 0}
+    verify_report = report
+    start_time = time.time()
+    in_flight = {}
+    last_submitted = None
+    completed = False
+
+    def handle_result(picture_id, filename, only_compressed, valid, verified=True):
+        if valid:
+            report["valid"] += 1
+            if verified:
+                record_local_file(filename)
+            return
+        logger.warning(
+            "Local image '{}' is missing or broken".format(filename))
+        report["broken" if os.path.exists(filename) else "missing"] += 1
+        remove_local_file(picture_id, only_compressed)
+
+    def save_progress():
+        if last_submitted is not None:
+            set_crawler_state("verify_local_files", json.dumps({"full_decode": full_decode, "picture_id": min(
+                in_flight.values()) - 1 if in_flight else last_submitted}))
+
+    try:
+        last_verify_timestamp = time.time()
+        set_crawler_state("last_verify_timestamp", last_verify_timestamp)
+        logger.info("Local image verification started with {} processes{}{}".format(processes, ", full decode" if full_decode else "",
+                                                                                   ", resuming after picture_id {}".format(after) if after is not None else ""))
+        cursor = get_read_connection(db_path).cursor()
+        with ThreadPoolExecutor(max_workers=1) as folder_executor, ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            folder_scan = folder_executor.submit(
+                scan_orphan_files, orphans, report)
+            for image in iterate_pictures(get_read_connection(db_path), "picture_id, local_filename, local_filename_compressed", "local_filename != ''", after):
+                if stop_verify_task:
+                    break
+                report["pictures"] += 1
+                # the compressed image is checked on its own unless it replaced the original
+                filenames = [(image["local_filename_compressed"], True)] if image["local_filename_compressed"] and image["local_filename_compressed"] != image["local_filename"] else []
+                for filename, only_compressed in filenames + [(image["local_filename"], False)]:
+                    report["checked"] += 1
+                    valid = check_local_file(filename, cursor)
+                    if valid is False or (valid and not full_decode):
+                        handle_result(
+                            image["picture_id"], filename, only_compressed, valid, False)
+                        continue
+                    # a few jobs per process are in flight
+                    while len(in_flight) >= processes * 2:
+                        finished, _ = wait(
+                            in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            handle_result(*future.result())
+                            del in_flight[future]
+                    in_flight[executor.submit(verify_job, (image["picture_id"], filename, only_compressed, full_decode))] = image["picture_id"]
+                    last_submitted = image["picture_id"]
+                if report["pictures"] % 1000 == 0:
+                    save_progress()
+                    elapsed = time.time() - start_time
+                    report["seconds"] = round(elapsed, 2)
+                    report["images_per_second"] = get_throughput(
+                        report["checked"], elapsed)
+            for future in as_completed(list(in_flight)):
+                handle_result(*future.result())
+                del in_flight[future]
+            folder_scan.result()
+        completed = not stop_verify_task
+    except Exception as e:
+        logger.error("Aborting local image verification due to error: " +
+                     str(e) + "\n" + traceback.format_exc())
+    finally:
+        if completed:
+            set_crawler_state("verify_local_files", "{}")
+        else:
+            save_progress()
+        elapsed = time.time() - start_time
+        report["running"] = False
+        report["seconds"] = round(elapsed, 2)
+        report["images_per_second"] = get_throughput(
+            report["checked"], elapsed)
+        set_crawler_state("verify_report", json.dumps(report))
+        logger.info("Local image verification {}: {}".format(
+            "finished" if completed else "stopped", report))
+        stop_verify_task = False
+        verifier_running = False
+
+
+def remove_unreferenced_file(filename):
+    # files may be shared by several pictures (content-addressed store), a file is only removed once no picture refers to it
+    if not filename or not os.path.exists(filename):
+        return False
+    with db_lock:
+        references = db.cursor().execute(
+            "SELECT (SELECT COUNT(*) FROM pictures WHERE local_filename = ?) + (SELECT COUNT(*) FROM pictures WHERE local_filename_compressed = ?)", (filename, filename)).fetchone()[0]
+        if references:
+            return False
+        os.remove(filename)
+        db.cursor().execute("DELETE FROM local_files WHERE filename = ?", (filename,))
+    return True
+
+
+def get_file_size(filename):
+    # size of a file in bytes, 0 if it does not exist (anymore)
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def get_throughput(count, seconds):
+    return round(count / seconds, 2) if seconds > 0 else 0
+
+
+def get_crawler_state(key, default=None):
+    with db_lock:
+        row = db.cursor().execute(
+            "SELECT value FROM crawler_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_crawler_state(key, value):
+    with db_lock:
+        db.cursor().execute(
+            "INSERT OR REPLACE INTO crawler_state (key, value) VALUES (?, ?)", (key, str(value)))
 
 
 # init logger
@@ -487,21 +953,285 @@ logger = logging.getLogger("uvicorn")
 # crawler status
 crawler_status = "idle"
 
-# read config and auth api
+# read config, the API client logs in when the server starts or before the first crawl
 read_config()
 
 # init variables
+api = None
+api_client_factory = create_api_client
 last_update_timestamp = -1
 dismiss_skip_message = False
+auth_lock = threading.Lock()
+db_lock = threading.RLock()
+crawl_progress = {}
+crawl_progress_lock = threading.Lock()
+verifier_running = False
+verifier_lock = threading.Lock()
+stop_verify_task = False
 
 # init database
 db = initDB(db_path)
+load_picture_index(db)
+last_update_timestamp = float(get_crawler_state("last_update_timestamp", -1))
+last_verify_timestamp = float(get_crawler_state("last_verify_timestamp", 0))
+verify_report = json.loads(get_crawler_state("verify_report", "{}"))
+
+
+def is_rate_limited_response(json_result):
+    # Pixiv API answers rate limited requests with {"error": {"message": "Rate Limit", ...}}
+    error = json_result.get("error") if isinstance(json_result, dict) else None
+    return bool(error) and "rate limit" in str(error).lower()
+
 
+def get_crawl_status(manual, force_update, dates, completed_units=0, total_units=0):
+    if not manual:
+        return 'crawling automatically since update_interval of ' + str(update_interval) + " has been reached"
+    return 'crawling manually {}{}'.format('and forcing updates ' if force_update else '', 'to crawl from date {} to {} [{}% completed]'.format(dates[0], dates[-1], round(completed_units/total_units*100, 2) if total_units else 0) if dates[0] != None else '')
 
-def crawl_images(manual=False, force_update=False, dates=[None]):
-    class RateLimitException(Exception):
-        pass
-    global last_update_timestamp, update_interval, crawler_status, dismiss_skip_message
+
+def get_crawl_progress():
+    # state of every (date, mode) unit of the current (or last) crawl: pending, crawling, completed or failed
+    with crawl_progress_lock:
+        return dict(crawl_progress)
+
+
+def get_pictures_without_file(picture_ids):
+    # picture_ids (of the given ones) of pictures without a local file
+    if not picture_ids:
+        return set()
+    return set(row[0] for row in get_read_connection(db_path).cursor().execute("SELECT picture_id FROM pictures WHERE local_filename = '' AND picture_id IN ({})".format(
+        ", ".join("?" * len(picture_ids))), picture_ids))
+
+
+def start_crawl_job(dates, modes, force_update):
+    # create the crawl job of a date range, or pick up its checkpoints if it was not finished
+    # returns job_id, {(date, mode): (next_url, completed)} and whether an unfinished job is resumed
+    job_id = xxhash.xxh64_hexdigest("{}_{}_{}_{}".format(
+        dates[0], dates[-1], ",".join(modes), force_update))
+    with db_lock:
+        cursor = db.cursor()
+        with db:
+            row = cursor.execute(
+                "SELECT status FROM crawl_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row and row[0] == "completed":
+                # a finished job is crawled again from the beginning
+                cursor.execute(
+                    "DELETE FROM crawl_progress WHERE job_id = ?", (job_id,))
+            cursor.execute("INSERT OR IGNORE INTO crawl_jobs (job_id, start_date, end_date, ranking_modes, force_update, status, created_timestamp, updated_timestamp) VALUES (?, ?, ?, ?, ?, 'running', ?, ?)", (
+                job_id, dates[0], dates[-1], ",".join(modes), int(force_update), time.time(), time.time()))
+            cursor.execute(
+                "UPDATE crawl_jobs SET status = 'running', updated_timestamp = ? WHERE job_id = ?", (time.time(), job_id))
+            checkpoints = dict(((date, mode), (next_url, bool(completed))) for date, mode, next_url, completed in cursor.execute(
+                "SELECT date, mode, next_url, completed FROM crawl_progress WHERE job_id = ?", (job_id,)))
+    return job_id, checkpoints, bool(row) and row[0] != "completed"
+
+
+def save_crawl_progress(job_id, date, mode, next_url, completed, pages=0, images=0, inserted=0):
+    # checkpoint a (date, mode) unit after one of its ranking pages has been stored
+    with db_lock:
+        db.cursor().execute("INSERT INTO crawl_progress (job_id, date, mode, next_url, completed, pages, images, inserted) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (job_id, date, mode) DO UPDATE SET next_url = excluded.next_url, completed = excluded.completed, pages = pages + excluded.pages, images = images + excluded.images, inserted = inserted + excluded.inserted", (
+            job_id, date, mode, next_url, int(completed), pages, images, inserted))
+
+
+class UnitCheckpoint:
+    """
+    Checkpoints of one (date, mode) unit of a crawl job. A page is only
+    checkpointed once every download it queued is done (in page order), as
+    pictures of checkpointed pages are known and never queued again when
+    an interrupted job is resumed. Pages are registered by the crawl thread
+    and completed by the download workers, which never wait for each other.
+    """
+
+    def __init__(self, job_id, date, mode):
+        self.job_id = job_id
+        self.date = date
+        self.mode = mode
+        self.pages = []
+        self.lock = threading.Lock()
+
+    def add_page(self, downloads: int, progress):
+        # progress is (next_url, completed, pages, images, inserted) as passed to save_crawl_progress, returns the page to pass to download_done
+        page = [downloads, progress]
+        with self.lock:
+            self.pages.append(page)
+            self.save()
+        return page
+
+    def download_done(self, page):
+        with self.lock:
+            page[0] -= 1
+            self.save()
+
+    def save(self):
+        while self.pages and self.pages[0][0] <= 0:
+            save_crawl_progress(self.job_id, self.date,
+                                self.mode, *self.pages.pop(0)[1])
+
+
+def finish_crawl_job(job_id, status):
+    with db_lock:
+        db.cursor().execute("UPDATE crawl_jobs SET status = ?, updated_timestamp = ? WHERE job_id = ?",
+                            (status, time.time(), job_id))
+
+
+def get_unfinished_crawl_job():
+    # latest crawl job that was interrupted (e.g. by a restart), returns (start_date, end_date, force_update, modes) or None
+    # the job is resumed with its own ranking modes, as its job_id (and checkpoints) depend on them even if ranking_modes changed since
+    with db_lock:
+        row = db.cursor().execute(
+            "SELECT start_date, end_date, force_update, ranking_modes FROM crawl_jobs WHERE status = 'running' ORDER BY updated_timestamp DESC LIMIT 1").fetchone()
+    return (row[0], row[1], bool(row[2]), row[3].split(",")) if row else None
+
+
+def crawl_ranking(date, mode, force_update, excluding_tags_matcher, download_queue, stop_event, job_id=None, next_url=None, resumed=False):
+    # crawl every page of one ranking (date, mode) unit, returns counters of this unit
+    # with a job_id, progress is checkpointed after every page (once its downloads are done) and the crawl starts from next_url if given
+    # a resumed job downloads the images of known pictures without a local file, inserted by the interrupted run after its last checkpoint
+    stats = {"images": 0, "db": 0, "known": 0, "pages": 0,
+             "fetch_seconds": 0, "insert_seconds": 0}
+    checkpoint = UnitCheckpoint(job_id, date, mode) if job_id else None
+    if stop_event.is_set():
+        return stats
+    with crawl_progress_lock:
+        crawl_progress[(date, mode)] = "crawling"
+    with auth_lock:
+        if api is None or (not api_host and get_token_expiration()):
+            auth_api(api is None)
+    if next_url:
+        next_qs = api.parse_qs(next_url)
+    elif date == None:
+        next_qs = {"mode": mode}
+    else:
+        next_qs = {"mode": mode, "date": date}
+    while next_qs and not stop_event.is_set():
+        page_images = stats["images"]
+        page_inserted = stats["db"]
+        page_known = 0
+        # downloads of this page, queued once its checkpoint is registered
+        queued = []
+        start_time = time.time()
+        json_result = api_rate_limiter.call(
+            api.illust_ranking, is_rate_limited=is_rate_limited_response, max_retries=max_rate_limit_retries, **next_qs)
+        stats["fetch_seconds"] += time.time() - start_time
+        pixiv_metrics.ranking_page_seconds.observe(
+            time.time() - start_time, mode)
+        stats["pages"] += 1
+        if json_result.illusts != None:
+            # items of this ranking page, inserted into database in one batch
+            page_items = []
+            page_downloads = []
+            # pks of known pictures whose download is queued again
+            pending_downloads = set()
+            for illust in json_result.illusts:
+                if (illust.type == "manga" and "manga" in excluding_tags_matcher.exact):
+                    continue
+                if (not allow_multiple_pages and illust.page_count > 1):
+                    continue
+                # if any tag of illust.tags matches excluding_tags, skip
+                if excluding_tags_matcher.match_tags(illust.tags):
+                    continue
+                urls = []
+                url = None
+                if illust.page_count == 1:
+                    if (download_quality == "original"):
+                        url = illust.meta_single_page.original_image_url
+                    elif (download_quality == "large"):
+                        url = illust.image_urls.large
+                    else:
+                        url = illust.image_urls.medium
+                if (url == None):
+                    for images in illust.meta_pages:
+                        if (download_quality == "original"):
+                            url = images.image_urls.original
+                        elif (download_quality == "large"):
+                            url = images.image_urls.large
+                        else:
+                            url = images.image_urls.medium
+                        urls.append(url)
+                        if (not get_all_multiple_pages):
+                            break
+                else:
+                    urls = [url]
+                pks = [str(illust.id) + "_" + str(i) for i in range(len(urls))]
+                # pictures already in database are skipped unless force_update
+                known = known_picture_ids([xxhash.xxh32_intdigest(
+                    pk) for pk in pks]) if not force_update else [False] * len(pks)
+                missing_files = get_pictures_without_file([xxhash.xxh32_intdigest(pk) for pk, is_known in zip(
+                    pks, known) if is_known]) if resumed and store_mode == "full" else set()
+                for i in range(len(urls)):
+                    url = urls[i]
+                    pk = pks[i]
+                    stats["images"] += 1
+                    if known[i]:
+                        page_known += 1
+                        if xxhash.xxh32_intdigest(pk) not in missing_files:
+                            continue
+                        pending_downloads.add(pk)
+                    local_filename = ""
+                    download_url = url
+                    if (store_mode == "full"):
+                        extension = get_extension(url)
+                        local_filename = slugify(
+                            f"{str(illust.id)}_{illust.user.name}_{illust.title}_p{str(i)}", True) + extension
+                        if download_reverse_proxy != "":
+                            download_url = url.replace(
+                                "i.pximg.net", download_reverse_proxy)
+                        local_filename = os.path.normpath(
+                            os.path.join(download_folder, local_filename))
+                        if content_addressed_storage:
+                            # the file is named after its content once downloaded, until then the picture has no local file
+                            local_filename = ""
+                    # the picture points at its file once the download worker has written it (files of earlier crawls are used at once)
+                    data = {"id": illust.id, "author_id": illust.user.id, "author_name": illust.user.name, "title": illust.title, "page_no": i,
+                            "page_count": illust.page_count, "orientation": get_image_orientation(illust.width, illust.height), "width": illust.width, "height": illust.height, "r18": illust.x_restrict, "ai_type": illust.illust_ai_type, "tags": illust.tags, "url": url, "local_filename": local_filename if local_filename and os.path.exists(local_filename) else ""}
+                    page_items.append((pk, data))
+                    page_downloads.append((download_url, local_filename))
+            if store_mode == "full" and content_addressed_storage:
+                # images already stored for another picture (or an earlier crawl) with the same url are shared instead of downloaded again
+                stored_files = get_stored_files(
+                    [data["url"] for _, data in page_items])
+                for _, data in page_items:
+                    data["local_filename"] = stored_files.get(data["url"], "")
+            # insert into database
+            start_time = time.time()
+            inserted = insertManyDB(page_items, force_update)
+            stats["insert_seconds"] += time.time() - start_time
+            for i in range(len(page_items)):
+                if (inserted[i] or page_items[i][0] in pending_downloads):
+                    stats["db"] += inserted[i]
+                    download_url, local_filename = page_downloads[i]
+                    # queue images for download if local_filename is not empty (or is to be named by content)
+                    if store_mode == "full" and content_addressed_storage and not page_items[i][1]["local_filename"]:
+                        queued.append((download_url, "", page_items[i][0]))
+                    elif(local_filename and not content_addressed_storage):
+                        if (not os.path.exists(download_folder)):
+                            os.makedirs(download_folder)
+                        queued.append(
+                            (download_url, local_filename, page_items[i][0]))
+            stats["known"] += page_known
+        next_url = json_result.next_url if get_all_ranking_pages else None
+        if next_url and stop_at_known_page and page_known and page_known == stats["images"] - page_images:
+            # the rest of the ranking has been crawled before
+            logger.info("Ranking page of " + str(date) + " " +
+                        mode + " already in database, stopping pagination")
+            next_url = None
+        page = None
+        if checkpoint:
+            page = checkpoint.add_page(len(queued), (next_url, not next_url, 1,
+                                                    stats["images"] - page_images, stats["db"] - page_inserted))
+        for download_url, local_filename, pk in queued:
+            download_queue.put((download_url, local_filename, pk, checkpoint, page))
+        if (not get_all_ranking_pages):
+            break
+        next_qs = api.parse_qs(next_url)
+    with crawl_progress_lock:
+        crawl_progress[(date, mode)] = "completed" if not stop_event.is_set() else "stopped"
+    return stats
+
+
+def crawl_images(manual=False, force_update=False, dates=[None], modes=None):
+    # modes are the ranking modes to crawl, the configured ranking_modes if None (an interrupted job is resumed with the modes it was started with)
+    global last_update_timestamp, update_interval, crawler_status, dismiss_skip_message, crawl_progress
     if (not manual and update_interval == 0):
         if not dismiss_skip_message:
             logger.info("Background crawl disabled, skipping crawl")
@@ -519,177 +1249,241 @@ def crawl_images(manual=False, force_update=False, dates=[None]):
                         crawler_status + ", skipping crawl")
             dismiss_skip_message = True
         return
-    crawler_status = 'crawling automatically since update_interval of ' + str(update_interval) + " has been reached" if not manual else 'crawling manually {}{}'.format(
-        'and forcing updates ' if force_update else '', 'to crawl from date {} to {}'.format(dates[0], dates[-1]) if dates[0] != None else '')
+    crawler_status = get_crawl_status(manual, force_update, dates)
+    modes = modes or get_list(ranking_modes)
     logger.info(
-        f"Crawler started with config: store_mode={store_mode}, download_folder={download_folder}, download_quality={download_quality}, download_reverse_proxy={download_reverse_proxy}, ranking_modes={get_list(ranking_modes)}, excluding_tags={get_list(excluding_tags)}, {'get_all_ranking_pages, ' if get_all_ranking_pages else ''}{'allow_multiple_pages, ' if allow_multiple_pages else ''}{'get_all_multiple_pages, ' if get_all_multiple_pages else ''}" + crawler_status)
+        f"Crawler started with config: store_mode={store_mode}, download_folder={download_folder}, download_quality={download_quality}, download_reverse_proxy={download_reverse_proxy}, ranking_modes={modes}, excluding_tags={get_list(excluding_tags)}, {'get_all_ranking_pages, ' if get_all_ranking_pages else ''}{'allow_multiple_pages, ' if allow_multiple_pages else ''}{'get_all_multiple_pages, ' if get_all_multiple_pages else ''}crawl_threads={crawl_threads}, max_requests_per_minute={max_requests_per_minute}, max_downloads_per_minute={max_downloads_per_minute}, " + crawler_status)
     dismiss_skip_message = False
-    image_count = 0
-    db_count = 0
-    download_count = 0
-    # convert excluding_tags to list and convert to lower case
-    excluding_tags_list = [tag.lower() for tag in get_list(excluding_tags)]
+    crawl_start_time = time.time()
+    # every (date, mode) pair is a unit of work, units are crawled concurrently by crawl_threads threads sharing the request budget
+    units = [(date, mode) for date in dates for mode in modes]
+    # crawls over past dates are checkpointed so that they could be resumed after an interruption
+    job_id = None
+    checkpoints = {}
+    resumed = False
+    if dates[0] != None:
+        job_id, checkpoints, resumed = start_crawl_job(
+            dates, modes, force_update)
+    finished_units = set(unit for unit in units if checkpoints.get(
+        unit, (None, False))[1])
+    if finished_units:
+        logger.info("Resuming crawl job {} with {}/{} ranking units already completed".format(
+            job_id, len(finished_units), len(units)))
+    with crawl_progress_lock:
+        crawl_progress = dict(
+            (unit, "completed" if unit in finished_units else "pending") for unit in units)
+    stats = {"images": 0, "db": 0, "known": 0, "pages": 0,
+             "fetch_seconds": 0, "insert_seconds": 0}
+    completed_units = len(finished_units)
+    crawler_status = get_crawl_status(
+        manual, force_update, dates, completed_units, len(units))
+    stop_event = threading.Event()
+    # start download workers, fed by a bounded queue so that ranking fetching and database insertion keep going while images are downloaded
+    download_queue = queue.Queue(maxsize=download_threads * 4)
+    download_stats = {"count": 0, "seconds": 0, "lock": threading.Lock()}
+    download_workers = []
+    if store_mode == "full":
+        for _ in range(download_threads):
+            worker = threading.Thread(target=download_worker, args=(
+                download_queue, download_stats), daemon=True)
+            worker.start()
+            download_workers.append(worker)
+    # compile excluding_tags once for the whole crawl
+    excluding_tags_matcher = TagMatcher(get_list(excluding_tags))
     # crawl images:
     try:
-        for date in dates:
-            crawler_status = 'crawling automatically since update_interval of ' + str(update_interval) + " has been reached" if not manual else 'crawling manually {}{}'.format('and forcing updates ' if force_update else '', 'to crawl from date {} to {} [{}% completed]'.format(dates[0], dates[-1], round(dates.index(date)/len(dates)*100, 2)) if dates[0] != None else '')
-            if get_token_expiration():
-                auth_api()
-            for mode in get_list(ranking_modes):
-                if date == None:
-                    next_qs = {"mode": mode}
-                else:
-                    next_qs = {"mode": mode, "date": date}
-                while next_qs:
-                    json_result = api.illust_ranking(**next_qs)
-                    rate_limit_retries_count = 0
-                    while "rate limit" in str(json_result).lower():
-                        if rate_limit_retries_count >= max_rate_limit_retries:
-                            raise RateLimitException
-                        rate_limit_retries_count += 1
-                        logger.warning(
-                            "Crawler rate limit encountered, retrying in 30 seconds (" + str(rate_limit_retries_count) + "/" + str(max_rate_limit_retries) + " retries)")
-                        # Pause for 30 seconds and try again
-                        time.sleep(30)
-                        json_result = api.illust_ranking(**next_qs)
-                    if json_result.illusts != None:
-                        for illust in json_result.illusts:
-                            if (illust.type == "manga" and "manga" in excluding_tags_list):
-                                continue
-                            if (not allow_multiple_pages and illust.page_count > 1):
-                                continue
-                            # if any tag in excluding_tags_list is in illust.tags, skip
-                            excluding_tags_found = False
-                            for tag in illust.tags:
-                                if (excluding_tags_list and ((tag.name is not None and substring_in_list(tag.name.lower(), excluding_tags_list)) or (tag.translated_name is not None and substring_in_list(tag.translated_name.lower(), excluding_tags_list)))):
-                                    excluding_tags_found = True
-                                    break
-                            if excluding_tags_found:
-                                continue
-                            urls = []
-                            url = None
-                            if illust.page_count == 1:
-                                if (download_quality == "original"):
-                                    url = illust.meta_single_page.original_image_url
-                                elif (download_quality == "large"):
-                                    url = illust.image_urls.large
-                                else:
-                                    url = illust.image_urls.medium
-                            if (url == None):
-                                for images in illust.meta_pages:
-                                    if (download_quality == "original"):
-                                        url = images.image_urls.original
-                                    elif (download_quality == "large"):
-                                        url = images.image_urls.large
-                                    else:
-                                        url = images.image_urls.medium
-                                    urls.append(url)
-                                    if (not get_all_multiple_pages):
-                                        break
-                            else:
-                                urls = [url]
-                            for i in range(len(urls)):
-                                url = urls[i]
-                                pk = str(illust.id) + "_" + str(i)
-                                local_filename = ""
-                                if (store_mode == "full"):
-                                    extension = get_extension(url)
-                                    local_filename = slugify(
-                                        f"{str(illust.id)}_{illust.user.name}_{illust.title}_p{str(i)}", True) + extension
-                                    if download_reverse_proxy != "":
-                                        download_url = url.replace(
-                                            "i.pximg.net", download_reverse_proxy)
-                                    local_filename = download_folder + os.sep + local_filename
-                                data = {"id": illust.id, "author_id": illust.user.id, "author_name": illust.user.name, "title": illust.title, "page_no": i,
-                                        "page_count": illust.page_count, "orientation": get_image_orientation(illust.width, illust.height), "r18": illust.x_restrict, "ai_type": illust.illust_ai_type, "tags": illust.tags, "url": url, "local_filename": local_filename}
-                                image_count += 1
-                                # insert into database
-                                if (insertDB(pk, data, force_update)):
-                                    db_count += 1
-                                    # download images if local_filename is not empty
-                                    if(local_filename):
-                                        if (not os.path.exists(download_folder)):
-                                            os.makedirs(download_folder)
-                                        if (api.download(download_url, name=local_filename)):
-                                            download_count += 1
-                    if (not get_all_ranking_pages):
-                        break
-                    next_qs = api.parse_qs(json_result.next_url)
+        with ThreadPoolExecutor(max_workers=max(1, min(crawl_threads, len(units)))) as executor:
+            futures = dict((executor.submit(crawl_ranking, date, mode, force_update, excluding_tags_matcher, download_queue, stop_event, job_id, checkpoints.get(
+                (date, mode), (None, False))[0], resumed), (date, mode)) for date, mode in units if (date, mode) not in finished_units)
+            for future in as_completed(futures):
+                try:
+                    unit_stats = future.result()
+                except Exception:
+                    with crawl_progress_lock:
+                        crawl_progress[futures[future]] = "failed"
+                    # stop the remaining units before giving up
+                    stop_event.set()
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise
+                for key in stats:
+                    stats[key] += unit_stats[key]
+                completed_units += 1
+                crawler_status = get_crawl_status(
+                    manual, force_update, dates, completed_units, len(units))
         last_update_timestamp = time.time()
+        set_crawler_state("last_update_timestamp", last_update_timestamp)
     except RateLimitException:
         logger.error(" Aborting crawler task due to error: rate limit retries of " + str(max_rate_limit_retries) + "/" + str(max_rate_limit_retries) + " reached")
     except Exception as e:
         logger.error("Aborting crawler task due to error: " +
                      str(e) + "\n" + traceback.format_exc())
+    finally:
+        # let the download workers drain the queue and stop
+        for _ in download_workers:
+            download_queue.put(None)
+        for worker in download_workers:
+            worker.join()
+        if job_id:
+            finish_crawl_job(job_id, "completed" if completed_units == len(
+                units) else "failed")
+    crawl_seconds = time.time() - crawl_start_time
+    logger.info(
+        f"Crawled {stats['images']} images, {stats['known']} images already in database skipped, {stats['db']} images added to database, {download_stats['count']} images downloaded in {round(crawl_seconds, 2)}s ({completed_units}/{len(units)} ranking units completed)")
     logger.info(
-        f"Crawled {image_count} images, {db_count} images added to database, {download_count} images downloaded")
+        f"Stage throughput: ranking fetch {stats['pages']} pages in {round(stats['fetch_seconds'], 2)}s ({get_throughput(stats['pages'], stats['fetch_seconds'])} pages/s), database insertion {stats['images']} images in {round(stats['insert_seconds'], 2)}s ({get_throughput(stats['images'], stats['insert_seconds'])} images/s), download {download_stats['count']} images with {len(download_workers)} workers in {round(download_stats['seconds'], 2)}s of worker time ({get_throughput(download_stats['count'], crawl_seconds)} images/s overall)")
+    logger.info("Rate limiter state: API " + str(api_rate_limiter.get_state()) +
+                ", download " + str(download_rate_limiter.get_state()))
+    logger.info("HTTP connection reuse since startup: " + pixiv_http.format_stats())
     crawler_status = "idle"
 
 
+def get_compressed_filename(original_filename):
+    extension = get_extension(original_filename)
+    return original_filename.lower().replace(extension, '') + "_compressed" + '.jpg'
+
+
+def save_compressed_images(updates):
+    # write back a batch of (local_filename, local_filename_compressed, picture_id, original_filename) in one transaction
+    # originals replaced by their compressed image (delete_original) are removed once no picture refers to them
+    if not updates:
+        return
+    with db_lock:
+        with db:
+            db.cursor().executemany(  # update both local_filename and local_filename_compressed
+                "UPDATE pictures SET local_filename = ?, local_filename_compressed = ? WHERE picture_id = ?", [update[:3] for update in updates])
+        for local_filename, compressed_filename, _, original_filename in updates:
+            record_local_file(compressed_filename)
+            if local_filename != original_filename:
+                remove_unreferenced_file(original_filename)
+    bump_generation()
+
+
 def compress_images(image_quality: int = 75, force_compress: bool = False, delete_original: bool = False):
     global db, crawler_status, stop_compression_task
     if (crawler_status != "idle"):
         logger.info("Crawler is currently " +
                     crawler_status + ", skipping image compression")
         return
-    cursor = db.cursor()
-    results = cursor_to_dict(cursor, "SELECT * FROM pictures WHERE local_filename != ''{}".format(" AND local_filename_compressed = ''" if not force_compress else ""))
+    where = "local_filename != ''{}".format(
+        " AND local_filename_compressed = ''" if not force_compress else "")
+    # an interrupted task with the same settings resumes after the last picture_id it had processed
+    checkpoint = json.loads(get_crawler_state("compress_images", "{}"))
+    after = None
+    if checkpoint.get("image_quality") == image_quality and checkpoint.get("force_compress") == force_compress:
+        after = checkpoint["picture_id"]
+    with db_lock:
+        total = db.cursor().execute("SELECT COUNT(*) FROM pictures WHERE {}{}".format(
+            where, " AND picture_id > ?" if after is not None else ""), [after] if after is not None else []).fetchone()[0]
+    processes = compress_processes or os.cpu_count() or 1
     crawler_status = "compressing images"
     logger.info(
-        "Image compression task started with quality {}".format(image_quality))
+        "Image compression task started with quality {} and {} processes{}".format(image_quality, processes, ", resuming after picture_id {}".format(after) if after is not None else ""))
+    # rows are streamed in picture_id order, so that memory does not grow with the library
+    jobs = ((image["picture_id"], (image["local_filename"], get_compressed_filename(image["local_filename"]), image_quality)) for image in iterate_pictures(
+        db, "picture_id, local_filename", where, after, lock=db_lock))
     count = 0
+    invalid = 0
+    done = 0
+    updates = []
+    stopping = False
+    in_flight = {}
+    last_submitted = None
+    completed = False
+    start_time = time.time()
+
+    def save_progress():
+        # every picture_id below the oldest image in progress has been processed and written back
+        nonlocal updates
+        save_compressed_images(updates)
+        updates = []
+        if last_submitted is not None:
+            set_crawler_state("compress_images", json.dumps({"image_quality": image_quality, "force_compress": force_compress, "picture_id": min(
+                in_flight.values()) - 1 if in_flight else last_submitted}))
+
     try:
-        for image in results:
-            crawler_status = "compressing images [{}% completed]".format(
-                round((results.index(image))/len(results)*100, 2))
-            if stop_compression_task:
-                logger.log(logging.INFO, "Stopping image compression task")
-                stop_compression_task = False
-                break
-            if not os.path.exists(image["local_filename"]):
-                continue
-            if os.path.exists(image["local_filename"]):
-                original_filename = image["local_filename"]
-                extension = get_extension(original_filename)
-                compressed_filename = original_filename.lower().replace(
-                    extension, '') + "_compressed" + '.jpg'
-                try:
-                    compress_image(original_filename,
-                                   compressed_filename, image_quality)
-                except (FileNotFoundError, UnidentifiedImageError):
-                    logger.log(logging.ERROR,
-                               "Skipping file '{}' due to being an invalid image".format(original_filename))
-                    remove_local_file(image["picture_id"])
-                    continue
-                if delete_original:
-                    os.remove(original_filename)
-                    original_filename = compressed_filename
-                cursor.execute(  # update both local_filename and local_filename_compressed
-                    "UPDATE pictures SET local_filename = ?, local_filename_compressed = ? WHERE picture_id = ?", (original_filename, compressed_filename, image["picture_id"]))
-                # commit by apsw
-                count += 1
+        # worker processes are spawned rather than forked, so that they do not inherit the database connection and threads of this process
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # only a few jobs per process are in flight, so that a stop request takes effect after them
+            for picture_id, job in itertools.islice(jobs, processes * 2):
+                in_flight[executor.submit(
+                    compress_job, (picture_id,) + job)] = picture_id
+                last_submitted = picture_id
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    picture_id, status, local_filename, compressed_filename = future.result()
+                    del in_flight[future]
+                    done += 1
+                    pixiv_metrics.compressed_images.inc(status)
+                    if status == "compressed":
+                        pixiv_metrics.compressed_bytes.inc(
+                            "original", amount=get_file_size(local_filename))
+                        pixiv_metrics.compressed_bytes.inc(
+                            "compressed", amount=get_file_size(compressed_filename))
+                        updates.append(
+                            (compressed_filename if delete_original else local_filename, compressed_filename, picture_id, local_filename))
+                        count += 1
+                    elif status == "invalid":
+                        logger.log(logging.ERROR,
+                                   "Skipping file '{}' due to being an invalid image".format(local_filename))
+                        remove_local_file(picture_id)
+                        invalid += 1
+                if stop_compression_task and not stopping:
+                    logger.log(logging.INFO, "Stopping image compression task, waiting for {} images in progress".format(
+                        len(in_flight)))
+                    stopping = True
+                if not stopping:
+                    for picture_id, job in itertools.islice(jobs, len(finished)):
+                        in_flight[executor.submit(
+                            compress_job, (picture_id,) + job)] = picture_id
+                        last_submitted = picture_id
+                if len(updates) >= 100:
+                    save_progress()
+                elapsed = time.time() - start_time
+                speed = done / elapsed if elapsed > 0 else 0
+                crawler_status = "compressing images [{}% completed, {} images/s, ETA {}s]".format(
+                    round(done/max(total, 1)*100, 2), round(speed, 2), round(max(total - done, 0) / speed) if speed else "unknown")
+        if stopping:
+            stop_compression_task = False
+        else:
+            completed = True
     except Exception as e:
         logger.log(logging.ERROR,
                    "Aborting image compression task due to error: " + str(e) + "\n" + traceback.format_exc())
-    logger.log(logging.INFO, "Compressed {} images, {} invalid images skipped and removed".format(
-        count, len(results) - count))
+    finally:
+        save_progress()
+        if completed:
+            # the whole table has been processed, the next task starts from the beginning
+            set_crawler_state("compress_images", "{}")
+    elapsed = time.time() - start_time
+    logger.log(logging.INFO, "Compressed {} images in {}s ({} images/s), {} invalid images skipped and removed, {} missing images skipped".format(
+        count, round(elapsed, 2), get_throughput(count, elapsed), invalid, done - count - invalid))
     crawler_status = "idle"
 
 
 def remove_local_file(picture_id, remove_only_compressed: bool = False):
     global db
-    picture_id = str(picture_id)
-    cursor = db.cursor()
-    image = cursor_to_dict(cursor, "SELECT * FROM pictures WHERE picture_id = " + picture_id)[0]
-    if image:
-        remove_only_compressed = (
-            image["local_filename_compressed"] != image["local_filename"]) and remove_only_compressed
-        logger.log(logging.INFO, ("Removing file '{}' and related references".format(
-            image["local_filename"])))
-        if not remove_only_compressed and image["local_filename"] and os.path.exists(image["local_filename"]):
-            os.remove(image["local_filename"])
-        if "local_filename_compressed" in image and os.path.exists(image["local_filename_compressed"]):
-            os.remove(image["local_filename_compressed"])
-        cursor.execute(
-            "UPDATE pictures SET local_filename_compressed = ''{} WHERE picture_id = ?".format(", local_filename = ''" if not remove_only_compressed else ""), (picture_id,))
-        # commit by apsw
+    with db_lock:
+        picture_id = str(picture_id)
+        cursor = db.cursor()
+        image = cursor_to_dict(cursor, "SELECT * FROM pictures WHERE picture_id = " + picture_id)[0]
+        if image:
+            remove_only_compressed = (
+                image["local_filename_compressed"] != image["local_filename"]) and remove_only_compressed
+            logger.log(logging.INFO, ("Removing file '{}' and related references".format(
+                image["local_filename"])))
+            cursor.execute(
+                "UPDATE pictures SET local_filename_compressed = ''{} WHERE picture_id = ?".format(", local_filename = ''" if not remove_only_compressed else ""), (picture_id,))
+            if not remove_only_compressed:
+                remove_unreferenced_file(image["local_filename"])
+            remove_unreferenced_file(image["local_filename_compressed"])
+            if not remove_only_compressed:
+                # derivatives of the image are removed with it
+                for (filename,) in cursor.execute("SELECT filename FROM derivatives WHERE picture_id = ?", (picture_id,)).fetchall():
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                cursor.execute(
+                    "DELETE FROM derivatives WHERE picture_id = ?", (picture_id,))
+            bump_generation()
+            # commit by apsw
@@ -1,18 +1,27 @@
 import os
+import re
+import time
+import mimetypes
 import logging
 import datetime
+import threading
 import configupdater
 import pixiv_crawler
+import pixiv_database
+import pixiv_metrics
+import pixiv_image_probe
 
-from PIL import Image, UnidentifiedImageError
+from pixiv_compressor import make_derivative
+from pixiv_tag_matcher import TagMatcher
 from typing import Optional, List
 from numpy.random import default_rng
-from fastapi import FastAPI, BackgroundTasks, Query as QueryParam
-from fastapi.responses import FileResponse, RedirectResponse, HTMLResponse, JSONResponse
+from email.utils import formatdate
+from fastapi import FastAPI, BackgroundTasks, Request, Query as QueryParam
+from fastapi.responses import Response, FileResponse, PlainTextResponse, StreamingResponse, RedirectResponse, HTMLResponse, JSONResponse
 
 
 def read_config():
-    global db, privilege_api_key, reverse_proxy, image_num_limit, author_num_limit, tag_num_limit, stop_compression_task
+    global privilege_api_key, reverse_proxy, image_num_limit, author_num_limit, tag_num_limit, tag_cache_size, query_cache_memory, derivative_folder, derivative_cache_size, derivative_quality, image_cache_max_age, stop_compression_task
     config = configupdater.ConfigUpdater()
     if not os.path.exists('config.ini'):
         # Create config file
@@ -85,6 +94,78 @@ def read_config():
     config.set("API", "tag_num_limit", tag_num_limit)
     if comment != "":
         config["API"]["tag_num_limit"].add_before.comment(comment)
+    # size of tag cache
+    comment = ""
+    if config.has_option("API", "tag_cache_size") and config["API"]["tag_cache_size"].value.isdigit():
+        tag_cache_size = int(config["API"]["tag_cache_size"].value)
+    else:
+        comment = "maximum number of tags kept in memory for API responses"
+        tag_cache_size = 10000
+        logger.warning(
+            "tag_cache_size invalid, using default: " + str(tag_cache_size))
+    config.set("API", "tag_cache_size", tag_cache_size)
+    if comment != "":
+        config["API"]["tag_cache_size"].add_before.comment(comment)
+    pixiv_database.tag_cache_size = tag_cache_size
+    pixiv_database.invalidate_tag_cache()
+    # memory budget of query cache
+    comment = ""
+    if config.has_option("API", "query_cache_memory") and config["API"]["query_cache_memory"].value.isdigit():
+        query_cache_memory = int(config["API"]["query_cache_memory"].value)
+    else:
+        comment = "memory budget (MB) for cached query results of random image APIs (set to 0 to disable query cache)"
+        query_cache_memory = 64
+        logger.warning(
+            "query_cache_memory invalid, using default: " + str(query_cache_memory))
+    config.set("API", "query_cache_memory", query_cache_memory)
+    if comment != "":
+        config["API"]["query_cache_memory"].add_before.comment(comment)
+    pixiv_database.query_cache_budget = query_cache_memory * 1024 * 1024
+    pixiv_database.bump_generation()
+    # folder of derivatives (resized/re-encoded images) generated for /api/v1/img
+    if config.has_option("API", "derivative_folder") and config["API"]["derivative_folder"].value != "":
+        derivative_folder = config["API"]["derivative_folder"].value
+    else:
+        derivative_folder = "derivatives"
+        logger.warning(
+            "derivative_folder invalid, using default: " + derivative_folder)
+    config.set("API", "derivative_folder", derivative_folder)
+    # disk budget of derivatives
+    comment = ""
+    if config.has_option("API", "derivative_cache_size") and config["API"]["derivative_cache_size"].value.isdigit():
+        derivative_cache_size = int(config["API"]["derivative_cache_size"].value)
+    else:
+        comment = "disk budget (MB) for derivatives generated by /api/v1/img width/format parameters, least recently used ones are removed first"
+        derivative_cache_size = 1024
+        logger.warning(
+            "derivative_cache_size invalid, using default: " + str(derivative_cache_size))
+    config.set("API", "derivative_cache_size", derivative_cache_size)
+    if comment != "":
+        config["API"]["derivative_cache_size"].add_before.comment(comment)
+    # image quality of derivatives
+    comment = ""
+    if config.has_option("API", "derivative_quality") and config["API"]["derivative_quality"].value.isdigit() and 1 <= int(config["API"]["derivative_quality"].value) <= 100:
+        derivative_quality = int(config["API"]["derivative_quality"].value)
+    else:
+        comment = "image quality (1-100) of derivatives"
+        derivative_quality = 80
+        logger.warning(
+            "derivative_quality invalid, using default: " + str(derivative_quality))
+    config.set("API", "derivative_quality", derivative_quality)
+    if comment != "":
+        config["API"]["derivative_quality"].add_before.comment(comment)
+    # max-age of served image files
+    comment = ""
+    if config.has_option("API", "image_cache_max_age") and config["API"]["image_cache_max_age"].value.isdigit():
+        image_cache_max_age = int(config["API"]["image_cache_max_age"].value)
+    else:
+        comment = "seconds browsers and CDNs may cache image files served by /api/v1/img/{picture_id} (Cache-Control max-age)"
+        image_cache_max_age = 86400
+        logger.warning(
+            "image_cache_max_age invalid, using default: " + str(image_cache_max_age))
+    config.set("API", "image_cache_max_age", image_cache_max_age)
+    if comment != "":
+        config["API"]["image_cache_max_age"].add_before.comment(comment)
     # reset stop compression task flag
     stop_compression_task = False
     # save config
@@ -95,31 +176,30 @@ def read_config():
         logger.warning("Empty database, please crawl images using /api/v1/crawl function with your privilege API key: " + privilege_api_key + " (e.g. /api/v1/crawl?api_key=" + privilege_api_key + ")")
 
 
-def randomDB(r18: int = 2, orientation: int = 3, num: int = 1, id: int = None, author_ids: List[int] = [], author_names: List[str] = [], title: str = "", ai_type: int = None, tags: List[str] = [], local_file: bool = False):
-    global db
-    cursor = db.cursor()
-    if pixiv_crawler.lenDB() == 0:
-        return []
+def randomDB(r18: int = 2, orientation: int = 3, num: int = 1, id: int = None, author_ids: List[int] = [], author_names: List[str] = [], title: str = "", ai_type: int = None, tags: List[str] = [], excluding_tags: List[str] = [], local_file: bool = False, endpoint: str = ""):
+    start_time = time.perf_counter()
+    cursor = read_cursor()
+    # numeric filters are applied on the in-memory index, the rest (names/title/tags/local file) in SQLite
+    index_filters = {}
     qs = []
     if r18 not in [0, 1, 2]:
         r18 = 2
     if r18 in [0, 1]:
-        qs.append("r18 == " + str(r18))
+        index_filters["r18"] = r18
     if orientation not in [0, 1, 2, 3]:
         orientation = 3
     if orientation in [0, 1, 2]:
-        qs.append("orientation == " + str(orientation))
+        index_filters["orientation"] = orientation
     if num < 1:
         num = 1
     if num > image_num_limit:
         num = image_num_limit
     if id:
-        qs.append("id == " + str(id))
+        index_filters["id"] = id
     if author_ids:
         if len(author_ids) > author_num_limit:
             author_ids = (author_ids)[:author_num_limit]
-        qs.append("author_id IN " +
-                  str(author_ids).replace("[", "(").replace("]", ")"))
+        index_filters["author_ids"] = author_ids
     if author_names and author_names != [""]:
         if len(author_names) > author_num_limit:
             author_names = (author_names)[:author_num_limit]
@@ -128,28 +208,249 @@ def randomDB(r18: int = 2, orientation: int = 3, num: int = 1, id: int = None, a
     if title:
         qs.append("title LIKE '" + title + "%'")
     if ai_type:
-        qs.append("ai_type == " + str(ai_type))
+        index_filters["ai_type"] = ai_type
     if tags and tags != [""]:
         if len(tags) > tag_num_limit:
             tags = (tags)[:tag_num_limit]
         tags = [tag + '*' for tag in tags]
         qs.append(
             "picture_id IN (SELECT picture_id FROM picture_tags WHERE tag_id IN (SELECT ROWID FROM tags_fts WHERE tags_fts MATCH '" + " OR ".join(tags) + "'))")
+    if excluding_tags and excluding_tags != [""]:
+        if len(excluding_tags) > tag_num_limit:
+            excluding_tags = (excluding_tags)[:tag_num_limit]
+        excluding_tags = sorted(set(tag.lower() for tag in excluding_tags))
+    else:
+        excluding_tags = []
 
     if local_file:
         qs.append("local_filename != ''")
     q = " AND ".join(qs)
+    # candidate picture_ids of this filter combination are cached until the database changes
+    key = (index_filters.get("r18"), index_filters.get("orientation"), index_filters.get("id"), tuple(sorted(index_filters.get("author_ids", []))), tuple(sorted(author_names)) if author_names and author_names != [""] else (
+    ), title, index_filters.get("ai_type"), tuple(sorted(tags)) if tags and tags != [""] else (), tuple(excluding_tags), bool(local_file))
+    picture_ids = pixiv_database.get_cached_picture_ids(key)
+    if picture_ids is None:
+        generation = pixiv_database.db_generation
+        if excluding_tags:
+            # tags are matched against the patterns on a cache miss only, the resulting picture_ids are cached with the rest of the filter
+            excluded_tag_ids = TagMatcher(excluding_tags).match_tag_ids(cursor)
+            if excluded_tag_ids:
+                q = " AND ".join(([q] if q else []) + ["picture_id NOT IN (SELECT picture_id FROM picture_tags WHERE tag_id IN ({}))".format(
+                    ", ".join(str(int(tag_id)) for tag_id in excluded_tag_ids))])
+        picture_ids = pixiv_database.match_picture_ids(
+            cursor, pixiv_database.filter_picture_ids(**index_filters), q)
+        pixiv_database.cache_picture_ids(key, picture_ids, generation)
+    if len(picture_ids) == 0:
+        pixiv_metrics.query_seconds.observe(
+            time.perf_counter() - start_time, "randomDB", endpoint)
+        return []
+    picked = [int(picture_id) for picture_id in random.choice(
+        picture_ids, size=min(num, len(picture_ids)), replace=False)]
     results = pixiv_crawler.cursor_to_dict(cursor,
-        "SELECT * FROM pictures WHERE picture_id IN (SELECT picture_id FROM pictures {}ORDER BY RANDOM() LIMIT {})".format("WHERE ({}) ".format(q) if q else "", num))
+        "SELECT * FROM pictures WHERE picture_id IN ({})".format(", ".join(str(picture_id) for picture_id in picked)))
+    # keep the random order of picked ids
+    results.sort(key=lambda item: picked.index(item["picture_id"]))
+    pixiv_metrics.query_seconds.observe(
+        time.perf_counter() - start_time, "randomDB", endpoint)
     return results
 
 
-def tagDB(picture_id):
-    global db
-    cursor = db.cursor()
-    results = pixiv_crawler.cursor_to_dict(cursor,
-        "SELECT name, translated_name FROM tags WHERE tag_id IN (SELECT tag_id FROM picture_tags WHERE picture_id == " + str(picture_id) + ")")
-    return results
+def tagDB(picture_ids: List[int], endpoint: str = ""):
+    # tags of all pictures in one query, returns {picture_id: [{"name": ..., "translated_name": ...}]}
+    with pixiv_metrics.query_seconds.time("tagDB", endpoint):
+        cursor = read_cursor()
+        return pixiv_database.get_tags(cursor, picture_ids)
+
+
+def get_cached_derivative(picture_id: int, width: int, format: str):
+    # filename of a cached derivative, None if it has not been made yet
+    key = (picture_id, width, format)
+    row = read_cursor().execute(
+        "SELECT filename FROM derivatives WHERE picture_id = ? AND width = ? AND format = ?", key).fetchone()
+    if row and os.path.exists(row[0]):
+        pixiv_metrics.cache_requests.inc("derivative", "hit")
+        # hits never wait for the writer connection, their access times are written in batches by flush_derivative_accesses
+        with derivative_access_lock:
+            derivative_accesses[key] = time.time()
+        return row[0]
+    return None
+
+
+def get_derivative(picture_id: int, source: str, width: int, format: str):
+    # resized/re-encoded copy of a local image, generated on first request and served from the derivative cache afterwards
+    # writes go through the single writer connection of the crawler
+    filename = get_cached_derivative(picture_id, width, format)
+    if filename:
+        return filename
+    pixiv_metrics.cache_requests.inc("derivative", "miss")
+    key = (picture_id, width, format)
+    if not os.path.exists(derivative_folder):
+        os.makedirs(derivative_folder)
+    filename = os.path.join(derivative_folder, "{}_{}.{}".format(
+        picture_id, width or "full", "jpg" if format == "jpeg" else format))
+    make_derivative(source, filename,
+                    width, format, derivative_quality)
+    with pixiv_crawler.db_lock:
+        pixiv_crawler.db.cursor().execute("INSERT OR REPLACE INTO derivatives (picture_id, width, format, filename, size, last_access_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                                          key + (filename, os.path.getsize(filename), time.time()))
+    evict_derivatives(key)
+    return filename
+
+
+def flush_derivative_accesses(cursor=None):
+    # write the last access times of derivative cache hits in one transaction, cursor of the writer connection if db_lock is held already
+    with derivative_access_lock:
+        accesses = [(timestamp,) + key for key, timestamp in derivative_accesses.items()]
+        derivative_accesses.clear()
+    if not accesses:
+        return
+    query = "UPDATE derivatives SET last_access_timestamp = MAX(last_access_timestamp, ?) WHERE picture_id = ? AND width = ? AND format = ?"
+    if cursor is not None:
+        cursor.executemany(query, accesses)
+        return
+    with pixiv_crawler.db_lock:
+        with pixiv_crawler.db:
+            pixiv_crawler.db.cursor().executemany(query, accesses)
+
+
+def flush_derivative_accesses_task():
+    # background thread writing the access times of cache hits every derivative_access_flush_interval seconds
+    while True:
+        time.sleep(derivative_access_flush_interval)
+        try:
+            flush_derivative_accesses()
+        except Exception as e:
+            logger.warning(
+                "Failed to save derivative access times due to error: " + str(e))
+
+
+def evict_derivatives(keep=None):
+    # remove least recently used derivatives until they fit in derivative_cache_size, except the one (picture_id, width, format) being served
+    budget = derivative_cache_size * 1024 * 1024
+    with pixiv_crawler.db_lock:
+        cursor = pixiv_crawler.db.cursor()
+        # recent hits count as well
+        flush_derivative_accesses(cursor)
+        total = cursor.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM derivatives").fetchone()[0]
+        while total > budget:
+            rows = cursor.execute(
+                "SELECT picture_id, width, format, filename, size FROM derivatives ORDER BY last_access_timestamp LIMIT 100").fetchall()
+            rows = [row for row in rows if row[:3] != keep]
+            if not rows:
+                break
+            for picture_id, width, format, filename, size in rows:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                cursor.execute("DELETE FROM derivatives WHERE picture_id = ? AND width = ? AND format = ?",
+                               (picture_id, width, format))
+                total -= size
+                if total <= budget:
+                    break
+
+
+def get_local_file(image):
+    # local file to serve for a picture (compressed one first), broken files are removed and an empty string is returned
+    filename = image["local_filename"]
+    serving_compressed = False
+    if "local_filename_compressed" in image and image["local_filename_compressed"]:
+        filename = image["local_filename_compressed"]
+        serving_compressed = True
+    if not filename:
+        return ""
+    # only an os.stat if the file is unchanged since it was recorded, otherwise it is parsed once and recorded
+    valid = pixiv_crawler.check_local_file(filename, read_cursor())
+    if valid is None:
+        valid = pixiv_crawler.verify_local_file(filename)
+    if not valid:
+        pixiv_crawler.remove_local_file(image["picture_id"], serving_compressed)
+        return ""
+    return filename
+
+
+def serve_image(request: Request, image, filename: str, width: int = None, format: str = None, cacheable: bool = True):
+    # serve a local image (or its derivative) with cache validators, answering conditional and byte range requests
+    # responses of random picks are not cacheable, as the same URL gives another image next time
+    # images are never upscaled, local files are at most as large as the original (pictures.width)
+    if width and image.get("width") and width >= image["width"]:
+        width = None
+    if width or format:
+        # derivatives are made from the original image if it is still there
+        source = image["local_filename"] if os.path.exists(
+            image["local_filename"]) else filename
+        derivative_format = "jpeg" if not format or format.lower() == "jpg" else format.lower()
+        derivative = get_cached_derivative(image["picture_id"], width or 0, derivative_format)
+        if not derivative and width and width >= pixiv_image_probe.get_image_size(source)[0]:
+            # smaller downloads (download_quality) and pictures without a recorded size are checked on a cache miss only, from the header of the file
+            width = None
+        if width or format:
+            filename = derivative or get_derivative(image["picture_id"], source, width or 0, derivative_format)
+    stat = os.stat(filename)
+    # strong validator from modification time and size, files are replaced rather than modified in place
+    etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+    headers = {"Access-Control-Allow-Origin": "*", "ETag": etag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+               "Cache-Control": "public, max-age={}".format(image_cache_max_age), "Accept-Ranges": "bytes"}
+    if not cacheable:
+        headers = {"Access-Control-Allow-Origin": "*",
+                   "Cache-Control": "no-store", "Accept-Ranges": "bytes"}
+    if_none_match = request.headers.get("if-none-match")
+    if cacheable and if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        # single byte range (bytes=start-end, bytes=start- or bytes=-suffix), other forms are answered with the whole file
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+        if match and match.group(1) + match.group(2):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), stat.st_size -
+                          1) if match.group(2) else stat.st_size - 1
+            else:
+                start = max(0, stat.st_size - int(match.group(2)))
+                end = stat.st_size - 1
+            if start > end or start >= stat.st_size:
+                return Response(status_code=416, headers={"Access-Control-Allow-Origin": "*", "Content-Range": "bytes */{}".format(stat.st_size)})
+            headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, end, stat.st_size)
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(read_file_range(filename, start, end), status_code=206, headers=headers, media_type=mimetypes.guess_type(filename)[0])
+    return FileResponse(filename, headers=headers)
+
+
+def read_file_range(filename: str, start: int, end: int, chunk_size: int = 64 * 1024):
+    with open(filename, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def collect_cache_metrics():
+    # query and tag caches keep their own statistics, they are mirrored into the registry at scrape time
+    query_cache = pixiv_database.get_query_cache_stats()
+    pixiv_metrics.cache_requests.set_total(
+        query_cache["hits"], "query", "hit")
+    pixiv_metrics.cache_requests.set_total(
+        query_cache["misses"], "query", "miss")
+    pixiv_metrics.cache_requests.set_total(
+        pixiv_database.tag_cache_hits, "tag", "hit")
+    pixiv_metrics.cache_requests.set_total(
+        pixiv_database.tag_cache_misses, "tag", "miss")
+    lookups = pixiv_metrics.cache_requests.samples()
+    for cache in ["query", "tag", "derivative"]:
+        hits = sum(value for _, labels, _, value in lookups if labels == (cache, "hit"))
+        misses = sum(value for _, labels, _, value in lookups if labels == (cache, "miss"))
+        pixiv_metrics.cache_hit_ratio.set(
+            hits / (hits + misses) if hits + misses else 0, cache)
+
+
+def read_cursor():
+    # cursor of the read-only connection of the calling thread
+    return pixiv_database.get_read_connection(pixiv_crawler.db_path).cursor()
 
 
 def convert_date(date_text):
@@ -175,37 +476,54 @@ def get_days_ago_date(days_ago: int):
 
 app = FastAPI()
 random = default_rng()
+# last access times of derivative cache hits not written to the database yet, {(picture_id, width, format): timestamp}
+derivative_accesses = {}
+derivative_access_lock = threading.Lock()
+derivative_access_flush_interval = 10
+pixiv_metrics.add_collector(collect_cache_metrics)
 
 
 @app.on_event("startup")
 async def startup_event():
-    global logger, db
+    global logger
     logger = logging.getLogger("uvicorn")
-    db = pixiv_crawler.initDB()
     read_config()
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    global db
-    db.close()
+    pixiv_crawler.auth_api(True)
+    threading.Thread(target=flush_derivative_accesses_task, daemon=True).start()
+    # resume the crawl job interrupted by the last shutdown
+    job = pixiv_crawler.get_unfinished_crawl_job()
+    if job:
+        start_date, end_date, force_update, modes = job
+        logger.info("Resuming interrupted crawl job from " +
+                    start_date + " to " + end_date + " (" + ", ".join(modes) + ")")
+        threading.Thread(target=pixiv_crawler.crawl_images, args=(True, force_update, get_dates(
+            convert_date(start_date), convert_date(end_date)), modes), daemon=True).start()
 
 
 @app.get("/", description="Get PixivCrawler API credit info and crawler status")
 def read_info():
-    return {"PixivCrawler": "GitHub@TNTcraftHIM", "status": "crawler is currently " + pixiv_crawler.get_crawler_status()}
+    # state of every (date, mode) unit of the current (or last) crawl, as "date mode": state
+    crawl_progress = {"{} {}".format(date, mode): state for (date, mode), state in sorted(pixiv_crawler.get_crawl_progress().items())}
+    return {"PixivCrawler": "GitHub@TNTcraftHIM", "status": "crawler is currently " + pixiv_crawler.get_crawler_status(), "crawl_progress": crawl_progress, "query_cache": pixiv_database.get_query_cache_stats()}
+
+
+@app.get("/metrics", description="Get crawler and API metrics in the Prometheus text format", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(pixiv_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/api/v1", description="Get image JSON according to query")
-def get_image_json(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), num: Optional[int] = QueryParam(default=1, description="Specify number of illustrations"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations")):
+def get_image_json(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), num: Optional[int] = QueryParam(default=1, description="Specify number of illustrations"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations"), excluding_tags: Optional[List[str]] = QueryParam(default=[], description="Exclude illustrations with any tag matching these patterns (tag for the whole tag, tag* for a prefix, *tag for a suffix, *tag* for a substring)")):
     background_tasks.add_task(pixiv_crawler.crawl_images)
     results = randomDB(r18=r18, orientation=orientation, num=num, id=id, author_ids=author_ids,
-                       author_names=author_names, title=title, ai_type=ai_type, tags=tags)
+                       author_names=author_names, title=title, ai_type=ai_type, tags=tags, excluding_tags=excluding_tags, endpoint="/api/v1")
     if not results:
         return {"status": "error", "data": "no result"}
+    # Look up tags of all results at once
+    tags = tagDB([item["picture_id"] for item in results], endpoint="/api/v1")
     for item in results:
-        # Look up tags and add to result
-        item["tags"] = tagDB(item["picture_id"])
+        # add tags to result
+        item["tags"] = tags[item["picture_id"]]
         item["url"] = item["url"].replace("i.pximg.net", reverse_proxy)
         del item["picture_id"]
         del item["local_filename"]
@@ -215,35 +533,51 @@ def get_image_json(background_tasks: BackgroundTasks, r18: Optional[int] = Query
 
 @app.get("/api/v1/img", description="Get image file from local storage according to query (need store_mode to be \"full\" and have files downloaded in local storage)")
 # directly return image file
-def get_image_file(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations")):
+def get_image_file(background_tasks: BackgroundTasks, request: Request, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations"), excluding_tags: Optional[List[str]] = QueryParam(default=[], description="Exclude illustrations with any tag matching these patterns (tag for the whole tag, tag* for a prefix, *tag for a suffix, *tag* for a substring)"), width: Optional[int] = QueryParam(default=None, description="Resize image to this width (keeping aspect ratio, images are never upscaled)"), format: Optional[str] = QueryParam(default=None, description="Re-encode image to this format (webp, jpeg), jpeg if only width is specified"), redirect: Optional[bool] = QueryParam(default=False, description="Whether to redirect to the cacheable URL of the image (/api/v1/img/{picture_id}) instead of returning the file")):
     background_tasks.add_task(pixiv_crawler.crawl_images)
-    filename = ""
-    for _ in range(pixiv_crawler.lenDB()):
+    if width is not None and width < 1:
+        return {"status": "error", "data": "invalid width, should be a positive integer"}
+    if format is not None and format.lower() not in ["webp", "jpeg", "jpg"]:
+        return {"status": "error", "data": "invalid format, should be webp or jpeg"}
+    if pixiv_crawler.is_verify_due():
+        background_tasks.add_task(pixiv_crawler.verify_local_files)
+    # picks are retried until a valid local image is found or none is left, every broken one is removed by get_local_file (which invalidates the cached picture_ids)
+    while True:
         results = randomDB(r18=r18, orientation=orientation, id=id, author_ids=author_ids,
-                           author_names=author_names, title=title, ai_type=ai_type, tags=tags, local_file=True)
+                           author_names=author_names, title=title, ai_type=ai_type, tags=tags, excluding_tags=excluding_tags, local_file=True, endpoint="/api/v1/img")
         if not results:
             return {"status": "error", "data": "no result"}
-        filename = results[0]["local_filename"]
-        serving_compressed = False
-        if "local_filename_compressed" in results[0] and results[0]["local_filename_compressed"]:
-            filename = results[0]["local_filename_compressed"]
-            serving_compressed = True
-        try:
-            Image.open(filename)
+        filename = get_local_file(results[0])
+        if filename:
             break
-        except (FileNotFoundError, UnidentifiedImageError):
-            pixiv_crawler.remove_local_file(
-                results[0]["picture_id"], serving_compressed)
+    if redirect:
+        # the random pick itself must not be cached, the image it points to is
+        url = "/api/v1/img/" + str(results[0]["picture_id"])
+        query = "&".join("{}={}".format(key, value) for key, value in [
+            ("width", width), ("format", format)] if value)
+        return RedirectResponse(url + ("?" + query if query else ""), status_code=302, headers={"Access-Control-Allow-Origin": "*", "Cache-Control": "no-store"})
+    return serve_image(request, results[0], filename, width, format, False)
+
+
+@app.get("/api/v1/img/{picture_id}", description="Get image file from local storage by picture_id, with cache validators (ETag, Last-Modified) and byte range support")
+def get_image_file_by_id(request: Request, picture_id: int, width: Optional[int] = QueryParam(default=None, description="Resize image to this width (keeping aspect ratio, images are never upscaled)"), format: Optional[str] = QueryParam(default=None, description="Re-encode image to this format (webp, jpeg), jpeg if only width is specified")):
+    if width is not None and width < 1:
+        return JSONResponse({"status": "error", "data": "invalid width, should be a positive integer"}, status_code=400)
+    if format is not None and format.lower() not in ["webp", "jpeg", "jpg"]:
+        return JSONResponse({"status": "error", "data": "invalid format, should be webp or jpeg"}, status_code=400)
+    results = pixiv_crawler.cursor_to_dict(
+        read_cursor(), "SELECT * FROM pictures WHERE picture_id = ?", (picture_id,))
+    filename = get_local_file(results[0]) if results else ""
     if not filename:
-        return {"status": "error", "data": "no result"}
-    return FileResponse(filename, headers={"Access-Control-Allow-Origin": "*"})
+        return JSONResponse({"status": "error", "data": "no result"}, status_code=404)
+    return serve_image(request, results[0], filename, width, format)
 
 
 @app.get("/api/v1/html", description="Get image in a HTML page according to query")
-def get_image_html(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations")):
+def get_image_html(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations"), excluding_tags: Optional[List[str]] = QueryParam(default=[], description="Exclude illustrations with any tag matching these patterns (tag for the whole tag, tag* for a prefix, *tag for a suffix, *tag* for a substring)")):
     background_tasks.add_task(pixiv_crawler.crawl_images)
     results = randomDB(r18=r18, orientation=orientation, id=id, author_ids=author_ids,
-                       author_names=author_names, title=title, ai_type=ai_type, tags=tags)
+                       author_names=author_names, title=title, ai_type=ai_type, tags=tags, excluding_tags=excluding_tags, endpoint="/api/v1/html")
     if not results:
         return {"status": "error", "data": "no result"}
     results = results[0]
@@ -254,10 +588,10 @@ def get_image_html(background_tasks: BackgroundTasks, r18: Optional[int] = Query
 
 
 @app.get("/api/v1/redirect", description="Get image and redirect to its URL according to query")
-def get_image_redirect(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations")):
+def get_image_redirect(background_tasks: BackgroundTasks, r18: Optional[int] = QueryParam(default=2, description="Whether to include R18 images (0 = No R18 images, 1 = Only R18 image, 2 = Both)"), orientation: Optional[int] = QueryParam(default=3, description="Specify images' orientation (0 = Landscape, 1 = Portrait, 2 = Square, 3 = Any)"), id: Optional[int] = QueryParam(default=None, description="Specify illustrations' ID"), author_ids: Optional[List[int]] = QueryParam(default=[], description="Specify list of authors' (ID) illustrations"), author_names: Optional[List[str]] = QueryParam(default=[], description="Specify list of authors' (name) illustrations"), title: Optional[str] = QueryParam(default="", description="Specify keywords in illustrations' title"), ai_type: Optional[int] = QueryParam(default=None, description="Specify illustrations' ai_type"), tags: Optional[List[str]] = QueryParam(default=[], description="Specify list of tags in illustrations"), excluding_tags: Optional[List[str]] = QueryParam(default=[], description="Exclude illustrations with any tag matching these patterns (tag for the whole tag, tag* for a prefix, *tag for a suffix, *tag* for a substring)")):
     background_tasks.add_task(pixiv_crawler.crawl_images)
     results = randomDB(r18=r18, orientation=orientation, id=id, author_ids=author_ids,
-                       author_names=author_names, title=title, ai_type=ai_type, tags=tags)
+                       author_names=author_names, title=title, ai_type=ai_type, tags=tags, excluding_tags=excluding_tags, endpoint="/api/v1/redirect")
     if not results:
         return {"status": "error", "data": "no result"}
     return RedirectResponse(results[0]["url"].replace("i.pximg.net", reverse_proxy), status_code=302, headers={"Access-Control-Allow-Origin": "*"})
@@ -309,6 +643,25 @@ def compress(background_tasks: BackgroundTasks, api_key: str, stop_task: Optiona
     return {"status": "success", "data": "image compression task added"}
 
 
+@app.get("/api/v1/verify", description="Check local images against the database, removing broken ones and handling orphan files (need api_key to work)")
+# verify local images (need correct api key to work)
+def verify(background_tasks: BackgroundTasks, api_key: str, stop_task: Optional[bool] = QueryParam(default=False, description="Whether to stop verification task if it is running"), report: Optional[bool] = QueryParam(default=False, description="Whether to only return the report of the running or last verification task"), full_decode: Optional[bool] = QueryParam(default=False, description="Whether to decode every image completely (finds truncated images, slower) instead of checking images changed since they were recorded"), orphans: Optional[str] = QueryParam(default="report", description="What to do with files in download folder that no picture refers to (report, delete, adopt = give them back to the picture they were downloaded for if its file is missing, delete the others)")):
+    if api_key != privilege_api_key:
+        return {"status": "error", "data": "invalid api key"}
+    if report:
+        return {"status": "success", "data": pixiv_crawler.get_verify_report()}
+    if stop_task:
+        pixiv_crawler.stop_verify_task = True
+        return {"status": "success", "data": "verification task stopped"}
+    if orphans not in ["report", "delete", "adopt"]:
+        return {"status": "error", "data": "invalid orphans, should be report, delete or adopt"}
+    if pixiv_crawler.verifier_running:
+        return {"status": "error", "data": "verification task is already running"}
+    background_tasks.add_task(
+        pixiv_crawler.verify_local_files, True, full_decode, orphans)
+    return {"status": "success", "data": "verification task added"}
+
+
 @app.get("/api/v1/reload", description="Reload config for crawler and API (need api_key to work)")
 # reload config for crawler and api
 # need correct api key to work
@@ -317,4 +670,5 @@ def reload(api_key: str):
         return {"status": "error", "data": "invalid api key"}
     read_config()
     pixiv_crawler.read_config()
+    pixiv_crawler.auth_api(True)
     return {"status": "success"}
@@ -0,0 +1,461 @@
+import apsw
+import threading
+import contextlib
+import numpy as np
+
+from collections import OrderedDict
+
+
+def initDB(db_path: str = "db.sqlite3"):
+    # the returned connection is the single writer of the database, readers use get_read_connection
+    db = apsw.Connection(db_path)
+    # in WAL mode readers work on a snapshot and neither block nor are blocked by the writer
+    db.cursor().execute("PRAGMA journal_mode = WAL;")
+    configure_connection(db)
+    cursor = db.cursor()
+
+    # Create pictures table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pictures (
+    picture_id INTEGER PRIMARY KEY,
+    id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    author_name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    page_no INTEGER NOT NULL,
+    page_count INTEGER NOT NULL,
+    orientation TINYINT NOT NULL,
+    r18 TINYINT NOT NULL,
+    ai_type TINYINT NOT NULL,
+    url TEXT NOT NULL,
+    local_filename TEXT NOT NULL DEFAULT '',
+    local_filename_compressed TEXT NOT NULL DEFAULT '',
+    width INTEGER,
+    height INTEGER
+    );''')
+    # width and height (NULL when unknown) were added later, databases created before get the columns
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(pictures)").fetchall()]
+    for column in ["width", "height"]:
+        if column not in columns:
+            cursor.execute("ALTER TABLE pictures ADD COLUMN {} INTEGER".format(column))
+
+    # Create indices for pictures table
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_author_name ON pictures(author_name);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_orientation ON pictures(orientation);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_r18 ON pictures(r18);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_ai_type ON pictures(ai_type);')
+    # url and local files are looked up to share files between pictures (content-addressed store)
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_url ON pictures(url);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_local_filename ON pictures(local_filename);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_pictures_local_filename_compressed ON pictures(local_filename_compressed);')
+
+    # Create tags table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tags (
+    tag_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    translated_name TEXT UNIQUE
+    );''')
+
+    # Create tags_fts table and triggers
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS tags_fts USING FTS5(name, translated_name, content="tags", content_rowid="tag_id", tokenize='unicode61');
+    ''')
+    # Create triggers for insert, delete and update operations
+    # Trigger for insert operation
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tags_ai AFTER INSERT ON tags BEGIN
+        INSERT INTO tags_fts(rowid, name, translated_name) VALUES (new.tag_id, new.name, new.translated_name);
+    END;
+    ''')
+    # Trigger for delete operation
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tags_ad AFTER DELETE ON tags BEGIN
+        INSERT INTO tags_fts(tags_fts, rowid, name, translated_name) VALUES('delete', old.tag_id, old.name, old.translated_name);
+    END;
+    ''')
+    # Trigger for update operation
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS tags_au AFTER UPDATE ON tags BEGIN
+        INSERT INTO tags_fts(tags_fts, rowid, name, translated_name) VALUES('delete', old.tag_id, old.name, old.translated_name);
+        INSERT INTO tags_fts(rowid, name, translated_name) VALUES (new.tag_id, new.name, new.translated_name);
+    END;
+    ''')
+
+    # Create picture_tags table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS picture_tags (
+    picture_id INTEGER REFERENCES pictures(picture_id) ON DELETE CASCADE ON UPDATE CASCADE,
+    tag_id INTEGER REFERENCES tags(tag_id) ON DELETE CASCADE ON UPDATE CASCADE,
+    PRIMARY KEY (picture_id, tag_id)
+    );''')
+
+    # Create indices for picture_tags table
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_picture_tags_picture_id ON picture_tags(picture_id);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_picture_tags_tag_id ON picture_tags(tag_id);')
+
+    # Create crawl_jobs table, one row per manual crawl over a date range
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS crawl_jobs (
+    job_id TEXT PRIMARY KEY,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    ranking_modes TEXT NOT NULL,
+    force_update TINYINT NOT NULL,
+    status TEXT NOT NULL,
+    created_timestamp REAL NOT NULL,
+    updated_timestamp REAL NOT NULL
+    );''')
+
+    # Create crawl_progress table, checkpoint of every (date, mode) unit of a crawl job
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS crawl_progress (
+    job_id TEXT REFERENCES crawl_jobs(job_id) ON DELETE CASCADE ON UPDATE CASCADE,
+    date TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    next_url TEXT,
+    completed TINYINT NOT NULL DEFAULT 0,
+    pages INTEGER NOT NULL DEFAULT 0,
+    images INTEGER NOT NULL DEFAULT 0,
+    inserted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, date, mode)
+    );''')
+
+    # Create derivatives table, resized/re-encoded copies of local images cached on disk for /api/v1/img (width 0 means original width)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS derivatives (
+    picture_id INTEGER REFERENCES pictures(picture_id) ON DELETE CASCADE ON UPDATE CASCADE,
+    width INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access_timestamp REAL NOT NULL,
+    PRIMARY KEY (picture_id, width, format)
+    );''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS index_derivatives_last_access_timestamp ON derivatives(last_access_timestamp);')
+
+    # Create local_files table, size and modification time of local images when they were written or last verified
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS local_files (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    verified_timestamp REAL NOT NULL
+    );''')
+
+    # Create crawler_state table for values that should survive restarts (e.g. last_update_timestamp)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS crawler_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+    );''')
+
+    # commit by apsw
+
+    return db
+
+
+def configure_connection(connection: apsw.Connection):
+    # per connection pragmas, synchronous NORMAL is safe from corruption in WAL mode (only the last commits may be lost on power failure)
+    connection.setbusytimeout(busy_timeout)
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA synchronous = NORMAL;")
+    cursor.execute("PRAGMA mmap_size = {};".format(mmap_size))
+    cursor.execute("PRAGMA cache_size = {};".format(-cache_size // 1024))
+
+
+def get_read_connection(db_path: str = "db.sqlite3"):
+    # read-only connection of the calling thread (opened on first use), so that reads scale with the threads of the API
+    connections = read_connections.__dict__.setdefault("connections", {})
+    if db_path not in connections:
+        connection = apsw.Connection(
+            db_path, flags=apsw.SQLITE_OPEN_READONLY)
+        configure_connection(connection)
+        connections[db_path] = connection
+    return connections[db_path]
+
+
+def cursor_to_dict(cursor: apsw.Cursor, query: str, bindings=None):
+    cursor.execute(query, bindings)
+    rows = cursor.fetchone()
+    if rows:
+        columns = [desc[0] for desc in cursor.getdescription()]
+        rows = [rows] + cursor.fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+    return []
+
+
+def iterate_pictures(connection: apsw.Connection, columns: str = "*", where: str = "", after=None, chunk_size: int = 1000, lock=None):
+    # stream rows of pictures as dicts in picture_id order, using keyset pagination so that memory stays bounded by chunk_size whatever the table size
+    # after is the last picture_id already processed (to resume a job), lock (if given) is only held while a chunk is read
+    cursor = connection.cursor()
+    while True:
+        conditions = [condition for condition in [
+            "picture_id > ?" if after is not None else "", "({})".format(where) if where else ""] if condition]
+        with lock or contextlib.nullcontext():
+            rows = cursor_to_dict(cursor, "SELECT {} FROM pictures {}ORDER BY picture_id LIMIT ?".format(columns, "WHERE " + " AND ".join(
+                conditions) + " " if conditions else ""), ([after] if after is not None else []) + [chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]["picture_id"]
+
+
+def load_picture_index(db):
+    # load the columns used by the common API filters into memory, so that filtering is done with numpy masks instead of SQLite queries
+    global picture_index, picture_index_count, picture_index_sorted, picture_index_sorted_count
+    cursor = db.cursor()
+    rows = cursor.execute(
+        "SELECT {} FROM pictures".format(", ".join(picture_index_columns))).fetchall()
+    index = {}
+    for i, (column, dtype) in enumerate(picture_index_columns.items()):
+        index[column] = np.fromiter(
+            (row[i] for row in rows), dtype=dtype, count=len(rows))
+    with picture_index_lock:
+        picture_index = index
+        picture_index_count = len(rows)
+        picture_index_sorted = np.sort(index["picture_id"])
+        picture_index_sorted_count = len(rows)
+
+
+def add_picture_index(rows):
+    # append rows of new pictures (values ordered as picture_index_columns), growing the arrays by doubling their capacity
+    global picture_index_count
+    if not rows:
+        return
+    with picture_index_lock:
+        capacity = len(picture_index["picture_id"])
+        if picture_index_count + len(rows) > capacity:
+            capacity = max(capacity * 2, picture_index_count + len(rows), 1024)
+            for column, dtype in picture_index_columns.items():
+                grown = np.empty(capacity, dtype=dtype)
+                grown[:picture_index_count] = picture_index[column][:picture_index_count]
+                picture_index[column] = grown
+        for i, column in enumerate(picture_index_columns):
+            picture_index[column][picture_index_count:picture_index_count + len(rows)] = [row[i] for row in rows]
+        picture_index_count += len(rows)
+
+
+def update_picture_index(rows):
+    # overwrite rows of pictures that are already indexed (e.g. after force_update)
+    if not rows:
+        return
+    rows = dict((row[0], row) for row in rows)
+    with picture_index_lock:
+        picture_ids = picture_index["picture_id"][:picture_index_count]
+        for position in np.nonzero(np.isin(picture_ids, list(rows)))[0]:
+            row = rows[int(picture_ids[position])]
+            for i, column in enumerate(picture_index_columns):
+                picture_index[column][position] = row[i]
+
+
+def get_picture_index():
+    with picture_index_lock:
+        return dict((column, values[:picture_index_count]) for column, values in picture_index.items())
+
+
+def known_picture_ids(picture_ids):
+    # membership of picture_ids among stored pictures (binary search over a sorted copy of the picture_id column), returns a boolean array
+    global picture_index_sorted, picture_index_sorted_count
+    picture_ids = np.asarray(picture_ids, dtype=np.int64)
+    with picture_index_lock:
+        if picture_index_sorted_count != picture_index_count:
+            # merge the pictures appended since the last lookup, a stable sort of two sorted runs is linear
+            appended = np.sort(picture_index["picture_id"][picture_index_sorted_count:picture_index_count])
+            picture_index_sorted = np.sort(np.concatenate((picture_index_sorted, appended)), kind="stable")
+            picture_index_sorted_count = picture_index_count
+        sorted_ids = picture_index_sorted
+    if not len(sorted_ids):
+        return np.zeros(len(picture_ids), dtype=bool)
+    positions = np.minimum(np.searchsorted(
+        sorted_ids, picture_ids), len(sorted_ids) - 1)
+    return sorted_ids[positions] == picture_ids
+
+
+def filter_picture_ids(r18: int = None, orientation: int = None, ai_type: int = None, id: int = None, author_ids: list = None):
+    # vectorized filtering over the in-memory index, None means no filter
+    index = get_picture_index()
+    if r18 is None and orientation is None and ai_type is None and id is None and not author_ids:
+        return index["picture_id"]
+    mask = np.ones(len(index["picture_id"]), dtype=bool)
+    if r18 is not None:
+        mask &= index["r18"] == r18
+    if orientation is not None:
+        mask &= index["orientation"] == orientation
+    if ai_type is not None:
+        mask &= index["ai_type"] == ai_type
+    if id is not None:
+        mask &= index["id"] == id
+    if author_ids:
+        mask &= np.isin(index["author_id"], author_ids)
+    return index["picture_id"][mask]
+
+
+def match_picture_ids(cursor: apsw.Cursor, ids, where: str = ""):
+    # all ids that also match the where clause
+    if not where or len(ids) == 0:
+        return ids
+    cursor.execute(
+        "SELECT picture_id FROM pictures WHERE ({})".format(where))
+    matched = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+    return ids[np.isin(ids, matched, assume_unique=True)]
+
+
+def bump_generation():
+    # mark every cached query result as stale, called whenever pictures are inserted or their local files change
+    global db_generation
+    with query_cache_lock:
+        db_generation += 1
+
+
+def get_cached_picture_ids(key):
+    # candidate picture_ids of a normalized filter tuple, None if missing or stale
+    global query_cache_hits, query_cache_misses, query_cache_bytes
+    with query_cache_lock:
+        entry = query_cache.get(key)
+        if entry is not None and entry[0] == db_generation:
+            query_cache.move_to_end(key)
+            query_cache_hits += 1
+            return entry[1]
+        if entry is not None:
+            del query_cache[key]
+            query_cache_bytes -= entry[1].nbytes
+        query_cache_misses += 1
+        return None
+
+
+def cache_picture_ids(key, ids, generation: int):
+    # store candidate picture_ids computed at generation, evicting least recently used entries to stay within the memory budget
+    global query_cache_bytes
+    with query_cache_lock:
+        if generation != db_generation or ids.nbytes > query_cache_budget:
+            return
+        if key in query_cache:
+            query_cache_bytes -= query_cache.pop(key)[1].nbytes
+        query_cache[key] = (generation, ids)
+        query_cache_bytes += ids.nbytes
+        while query_cache_bytes > query_cache_budget:
+            query_cache_bytes -= query_cache.popitem(last=False)[1][1].nbytes
+
+
+def get_query_cache_stats():
+    with query_cache_lock:
+        return {"hits": query_cache_hits, "misses": query_cache_misses, "entries": len(query_cache), "bytes": query_cache_bytes, "generation": db_generation}
+
+
+def get_tags(cursor: apsw.Cursor, picture_ids):
+    # look up tags of several pictures with one query, returns {picture_id: [{"name": ..., "translated_name": ...}]}
+    tags = dict((picture_id, []) for picture_id in picture_ids)
+    if not tags:
+        return tags
+    rows = cursor.execute("SELECT picture_id, tag_id FROM picture_tags WHERE picture_id IN ({}) ORDER BY tag_id".format(
+        ", ".join(str(int(picture_id)) for picture_id in tags))).fetchall()
+    names = get_tag_names(cursor, set(tag_id for _, tag_id in rows))
+    for picture_id, tag_id in rows:
+        if tag_id in names:
+            tags[picture_id].append(
+                {"name": names[tag_id][0], "translated_name": names[tag_id][1]})
+    return tags
+
+
+def get_tag_names(cursor: apsw.Cursor, tag_ids):
+    # resolve tag_id -> (name, translated_name) through the LRU tag cache, misses are fetched with one query
+    global tag_cache_hits, tag_cache_misses
+    names = {}
+    missing = []
+    with tag_cache_lock:
+        for tag_id in tag_ids:
+            if tag_id in tag_cache:
+                tag_cache.move_to_end(tag_id)
+                names[tag_id] = tag_cache[tag_id]
+            elif tag_id is not None:
+                missing.append(tag_id)
+        tag_cache_hits += len(names)
+        tag_cache_misses += len(missing)
+    if missing:
+        rows = cursor.execute("SELECT tag_id, name, translated_name FROM tags WHERE tag_id IN ({})".format(
+            ", ".join(str(int(tag_id)) for tag_id in missing))).fetchall()
+        with tag_cache_lock:
+            for tag_id, name, translated_name in rows:
+                names[tag_id] = (name, translated_name)
+                tag_cache[tag_id] = (name, translated_name)
+            while len(tag_cache) > tag_cache_size:
+                tag_cache.popitem(last=False)
+    return names
+
+
+def invalidate_tag_cache(tag_ids=None):
+    # drop cached tag names (all of them if tag_ids is None), e.g. after tags are updated
+    with tag_cache_lock:
+        if tag_ids is None:
+            tag_cache.clear()
+        else:
+            for tag_id in tag_ids:
+                tag_cache.pop(tag_id, None)
+
+
+@contextlib.contextmanager
+def count_queries(connection: apsw.Connection = None):
+    # count statements executed on connection, e.g. to check how many queries a request costs
+    # without a connection, every connection of the process is counted (e.g. the read connections of the API's worker threads, opened before or during the block)
+    # yields {"queries": count, "statements": [sql, ...]}
+    counter = {"queries": 0, "statements": []}
+    traced = []
+
+    def trace(target):
+        previous_tracer = target.exec_trace
+
+        def tracer(cursor, sql, bindings):
+            counter["queries"] += 1
+            counter["statements"].append(sql)
+            return previous_tracer(cursor, sql, bindings) if previous_tracer else True
+        target.exec_trace = tracer
+        traced.append((target, previous_tracer))
+
+    for target in [connection] if connection is not None else apsw.connections():
+        trace(target)
+    if connection is None:
+        apsw.connection_hooks.append(trace)
+    try:
+        yield counter
+    finally:
+        if connection is None:
+            apsw.connection_hooks.remove(trace)
+        for target, previous_tracer in traced:
+            target.exec_trace = previous_tracer
+
+
+# connection settings, cache_size is per connection
+busy_timeout = 5000
+mmap_size = 256 * 1024 * 1024
+cache_size = 16 * 1024 * 1024
+# read-only connections of each thread, {db_path: connection}
+read_connections = threading.local()
+
+# in-memory columnar index of pictures, shared by the crawler (writer) and the API (reader)
+picture_index_columns = {"picture_id": np.int64, "id": np.int64, "author_id": np.int64,
+                         "r18": np.int8, "orientation": np.int8, "ai_type": np.int8}
+picture_index = dict((column, np.empty(0, dtype=dtype))
+                     for column, dtype in picture_index_columns.items())
+picture_index_count = 0
+# sorted picture_ids for membership lookups, merged lazily with pictures appended to the index
+picture_index_sorted = np.empty(0, dtype=np.int64)
+picture_index_sorted_count = 0
+picture_index_lock = threading.Lock()
+
+# LRU cache of tag_id -> (name, translated_name)
+tag_cache = OrderedDict()
+tag_cache_size = 10000
+tag_cache_hits = 0
+tag_cache_misses = 0
+tag_cache_lock = threading.Lock()
+
+# versioned LRU cache of normalized filter tuple -> (generation, candidate picture_ids)
+query_cache = OrderedDict()
+query_cache_budget = 64 * 1024 * 1024
+query_cache_bytes = 0
+query_cache_hits = 0
+query_cache_misses = 0
+db_generation = 0
+query_cache_lock = threading.Lock()
@@ -0,0 +1,202 @@
+import io
+import re
+import json
+import time
+import zlib
+import random
+import threading
+import numpy as np
+
+from PIL import Image
+from argparse import ArgumentParser
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakePixivService:
+    """
+    Local stand-in for the Pixiv app API and its image host, so that crawls
+    could be benchmarked and tested without network access. Ranking pages
+    are generated deterministically from (mode, date, offset) and paginated
+    with next_url, images are served from the same host. Latency and rate
+    limit responses could be injected, and every response is counted in stats.
+    Point the crawler at it with the api_host option (see pixiv_crawler).
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, pages: int = 5, illusts_per_page: int = 30, multiple_pages_ratio: float = 0.1, tag_vocab: int = 1000, image_size=(600, 800), latency: float = 0, image_latency: float = 0, rate_limit_ratio: float = 0, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.pages = pages
+        self.illusts_per_page = illusts_per_page
+        self.multiple_pages_ratio = multiple_pages_ratio
+        self.tag_vocab = tag_vocab
+        self.image_size = image_size
+        self.latency = latency
+        self.image_latency = image_latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.server = None
+        self.url = ""
+        self.image = b""
+        self.stats = {"ranking_requests": 0, "image_requests": 0,
+                      "image_bytes": 0, "rate_limited": 0}
+        self.lock = threading.Lock()
+
+    def start(self):
+        # serve in a daemon thread, returns the base URL of the service
+        self.image = make_image(self.image_size, self.seed)
+        service = self
+
+        class Handler(FakePixivHandler):
+            pass
+        Handler.service = service
+        self.server = FakePixivServer((self.host, self.port), Handler)
+        self.url = "http://{}:{}".format(self.host, self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def rate_limited(self):
+        with self.lock:
+            return self.random.random() < self.rate_limit_ratio
+
+    def ranking(self, mode: str, date: str, offset: int):
+        # one ranking page, illust ids are unique per (mode, date) so that every unit of a crawl inserts new pictures
+        base = zlib.crc32("{}_{}".format(mode, date).encode()) % 100000 * 100000
+        illusts = []
+        for i in range(offset, min(offset + self.illusts_per_page, self.pages * self.illusts_per_page)):
+            illusts.append(self.illust(base + i, "r18" in mode))
+        next_url = None
+        if offset + self.illusts_per_page < self.pages * self.illusts_per_page:
+            next_url = "{}/v1/illust/ranking?mode={}&filter=for_ios{}&offset={}".format(
+                self.url, mode, "&date=" + date if date else "", offset + self.illusts_per_page)
+        return {"illusts": illusts, "next_url": next_url}
+
+    def illust(self, illust_id: int, r18: bool):
+        # illust payload with the fields read by the crawler, derived from illust_id only
+        rng = random.Random(illust_id)
+        page_count = rng.randint(2, 4) if rng.random() < self.multiple_pages_ratio else 1
+        user_id = rng.randint(1, 5000)
+        urls = [dict(("{}".format(quality), "{}/img/{}/{}_p{}.jpg".format(self.url, quality, illust_id, page))
+                     for quality in ["square_medium", "medium", "large", "original"]) for page in range(page_count)]
+        tags = []
+        for tag_no in sorted(set(int(rng.paretovariate(1)) % self.tag_vocab for _ in range(rng.randint(1, 8)))):
+            tags.append({"name": "tag{}".format(tag_no),
+                        "translated_name": "tag {}".format(tag_no) if tag_no % 2 else None})
+        width, height = rng.choice([(1200, 1600), (1600, 1200), (1000, 1000), (900, 1600)])
+        return {"id": illust_id, "title": "illust {}".format(illust_id), "type": "illust", "page_count": page_count, "width": width, "height": height,
+                "x_restrict": 1 if r18 else 0, "illust_ai_type": rng.choice([0, 1, 2]), "user": {"id": user_id, "name": "user {}".format(user_id)}, "tags": tags,
+                "image_urls": {"square_medium": urls[0]["square_medium"], "medium": urls[0]["medium"], "large": urls[0]["large"]},
+                "meta_single_page": {"original_image_url": urls[0]["original"]} if page_count == 1 else {},
+                "meta_pages": [{"image_urls": page_urls} for page_urls in urls] if page_count > 1 else []}
+
+
+class FakePixivServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients may close a connection before reading a whole image (e.g. when probing its size)
+        pass
+
+
+class FakePixivHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without TCP_NODELAY small responses on keep-alive connections wait for delayed ACKs
+    disable_nagle_algorithm = True
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict((key, values[-1])
+                     for key, values in parse_qs(url.query).items())
+        if url.path == "/v1/illust/ranking":
+            if self.service.latency:
+                time.sleep(self.service.latency)
+            self.service.count("ranking_requests")
+            if self.service.rate_limited():
+                # the shape of Pixiv's answer to rate limited requests
+                self.service.count("rate_limited")
+                return self.send_json({"error": {"user_message": "", "message": "Rate Limit", "reason": "", "user_message_details": {}}}, 403)
+            return self.send_json(self.service.ranking(query.get("mode", "day"), query.get("date", ""), int(query.get("offset", 0))))
+        if url.path == "/v1/user/detail":
+            return self.send_json({"user": {"id": int(query.get("user_id", 0)), "name": "offline"}})
+        if url.path.startswith("/img/"):
+            if self.service.image_latency:
+                time.sleep(self.service.image_latency)
+            # bytes appended after the end of the JPEG are ignored by decoders, they make every image distinct (e.g. for content-addressed storage)
+            body = self.service.image + url.path.encode()
+            self.service.count("image_requests")
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                # single byte ranges only, as requested by the image size prober
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+                if start >= len(body):
+                    return self.send_body(b"", "image/jpeg", 416, {"Content-Range": "bytes */{}".format(len(body))})
+                self.service.count("image_bytes", end + 1 - start)
+                return self.send_body(body[start:end + 1], "image/jpeg", 206, {"Content-Range": "bytes {}-{}/{}".format(start, end, len(body))})
+            self.service.count("image_bytes", len(body))
+            return self.send_body(body, "image/jpeg")
+        self.send_json({"error": {"message": "Not Found"}}, 404)
+
+    def send_json(self, data, status: int = 200):
+        self.send_body(json.dumps(data).encode(), "application/json", status)
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_image(image_size, seed: int = 0):
+    # a JPEG shaped like an illustration (gradient plus noise), shared by every image of the service
+    width, height = image_size
+    rng = np.random.default_rng(seed)
+    pixels = np.add.outer(np.linspace(0, 160, height), np.linspace(0, 80, width))[
+        :, :, None] + rng.integers(0, 24, (height, width, 3))
+    output = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--pages", type=int, default=5,
+                        help="ranking pages per (mode, date)")
+    parser.add_argument("--illusts-per-page", type=int, default=30)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[600, 800],
+                        metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every API response")
+    parser.add_argument("--image-latency", type=float, default=0,
+                        help="seconds added to every image response")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0,
+                        help="share of ranking requests answered with a rate limit error")
+    args = parser.parse_args()
+    service = FakePixivService(args.host, args.port, args.pages, args.illusts_per_page, image_size=args.image_size,
+                               latency=args.latency, image_latency=args.image_latency, rate_limit_ratio=args.rate_limit_ratio)
+    print("Fake Pixiv service listening on " + service.start() +
+          ", set api_host = " + service.url + " in the [Crawler] section of config.ini to crawl from it")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        service.stop()
@@ -0,0 +1,135 @@
+import threading
+import requests
+import pixiv_metrics
+
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# shared HTTP transport of the crawler, the Pixiv API client, authentication and image probing
+# configured from [Auth] http_proxy and the crawler's concurrency by pixiv_crawler.read_config
+
+http_requests = pixiv_metrics.counter(
+    "pixiv_http_requests_total", "HTTP requests sent through the shared transport", ("host",))
+http_connections = pixiv_metrics.counter(
+    "pixiv_http_connections_total", "HTTP connections opened by the shared transport (requests minus connections were sent on reused keep-alive connections)", ("host",))
+
+
+class ConnectionStats:
+    # counts requests and new connections per host of urllib3 connection pools
+    def _new_conn(self):
+        http_connections.inc(self.host)
+        return super()._new_conn()
+
+    def _make_request(self, conn, *args, **kwargs):
+        http_requests.inc(self.host)
+        return super()._make_request(conn, *args, **kwargs)
+
+
+class StatsHTTPConnectionPool(ConnectionStats, HTTPConnectionPool):
+    pass
+
+
+class StatsHTTPSConnectionPool(ConnectionStats, HTTPSConnectionPool):
+    pass
+
+
+pool_classes_by_scheme = {"http": StatsHTTPConnectionPool,
+                          "https": StatsHTTPSConnectionPool}
+
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter keeping up to pool_maxsize keep-alive connections per host
+    (a hard limit with pool_block, otherwise connections above it are closed
+    after use), counting requests and new connections per host. ssl_context
+    and source_address are passed to the pools, so that it could replace a
+    cloudscraper adapter without changing its TLS settings.
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10, pool_block: bool = False, max_retries=0, ssl_context=None, source_address=None):
+        self.ssl_context = ssl_context
+        self.source_address = source_address
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                         pool_block=pool_block, max_retries=max_retries)
+
+    def pool_kwargs(self, kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        if self.source_address is not None:
+            kwargs["source_address"] = self.source_address
+        return kwargs
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **self.pool_kwargs(kwargs))
+        self.poolmanager.pool_classes_by_scheme = pool_classes_by_scheme
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **self.pool_kwargs(proxy_kwargs))
+        if not proxy.lower().startswith("socks"):
+            # SOCKS proxies use pools of their own, which are not counted
+            manager.pool_classes_by_scheme = pool_classes_by_scheme
+        return manager
+
+
+def configure(http_proxy: str = None, connections: int = None, connections_per_host: int = None):
+    # arguments left to None keep their current value, the shared session is rebuilt on next use if anything changed
+    global proxy, max_connections, max_connections_per_host, session
+    settings = (proxy if http_proxy is None else http_proxy, max_connections if connections is None else max(connections, 1),
+                max_connections_per_host if connections_per_host is None else connections_per_host)
+    with session_lock:
+        if settings != (proxy, max_connections, max_connections_per_host):
+            proxy, max_connections, max_connections_per_host = settings
+            # requests in flight keep the previous session until they are done
+            session = None
+
+
+def reserve_connections(connections: int):
+    # grow the pools for a caller about to send that many concurrent requests (e.g. image probing), they never shrink here
+    if connections > max_connections:
+        configure(connections=connections)
+
+
+def mount(target, use_proxy: bool = True):
+    # replace the adapters of a session (e.g. the cloudscraper session of pixivpy) with pooled ones and route it through the proxy unless use_proxy is False
+    for prefix, adapter in list(target.adapters.items()):
+        target.mount(prefix, PooledAdapter(pool_maxsize=max_connections_per_host or max_connections, pool_block=bool(max_connections_per_host),
+                                           max_retries=adapter.max_retries, ssl_context=getattr(adapter, "ssl_context", None), source_address=getattr(adapter, "source_address", None)))
+    if proxy and use_proxy:
+        target.proxies.update({"http": proxy, "https": proxy})
+    return target
+
+
+def get_session():
+    # the shared session used for every request that is not sent by the Pixiv API client
+    global session
+    with session_lock:
+        if session is None:
+            session = mount(requests.Session())
+        return session
+
+
+def get_stats():
+    # {host: {"requests": ..., "connections": ..., "reused": ...}} since startup
+    with http_requests.lock:
+        request_counts = dict(http_requests.values)
+    with http_connections.lock:
+        connection_counts = dict(http_connections.values)
+    stats = {}
+    for (host,) in set(request_counts) | set(connection_counts):
+        requests_count = request_counts.get((host,), 0)
+        connections_count = connection_counts.get((host,), 0)
+        stats[host] = {"requests": requests_count, "connections": connections_count,
+                       "reused": max(requests_count - connections_count, 0)}
+    return stats
+
+
+def format_stats():
+    # one line summary of get_stats for logs
+    return ", ".join("{} {} requests over {} connections ({}% reused)".format(host, stat["requests"], stat["connections"], round(stat["reused"] * 100 / stat["requests"]) if stat["requests"] else 0)
+                     for host, stat in sorted(get_stats().items())) or "no requests"
+
+
+proxy = ""
+max_connections = 10
+max_connections_per_host = 0
+session = None
+session_lock = threading.Lock()
@@ -0,0 +1,159 @@
+import struct
+import pixiv_http
+
+from PIL import Image
+
+# JPEG start of frame markers (every 0xC0-0xCF marker except DHT, JPG and DAC), followed by precision, height and width
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class RemoteImage:
+    """
+    Random access to the bytes of a remote image for header parsing. Every
+    read outside of the buffered window is one Range request of at least
+    chunk_size bytes, read to the end so that the connection goes back to
+    the pool of the session (the shared pixiv_http session by default).
+    Servers ignoring Range answer with the whole image, which is then
+    streamed only as far as the parser reads.
+    """
+
+    def __init__(self, url: str, session=None, chunk_size: int = 8192, timeout: float = 30):
+        self.url = url
+        self.session = session or pixiv_http.get_session()
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.buffer_offset = 0
+        self.response = None
+        self.requests = 0
+
+    def read(self, offset: int, length: int):
+        end = offset + length
+        if self.buffer_offset <= offset and end <= self.buffer_offset + len(self.buffer):
+            return bytes(self.buffer[offset - self.buffer_offset:end - self.buffer_offset])
+        if self.response is not None:
+            # the whole image is being streamed, bytes before offset have to be read anyway
+            while len(self.buffer) < end:
+                chunk = self.response.raw.read(
+                    max(self.chunk_size, end - len(self.buffer)), decode_content=True)
+                if not chunk:
+                    break
+                self.buffer += chunk
+            return bytes(self.buffer[offset:end])
+        self.requests += 1
+        response = self.session.get(self.url, headers={"Range": "bytes={}-{}".format(
+            offset, offset + max(length, self.chunk_size) - 1)}, stream=True, timeout=self.timeout)
+        if response.status_code == 206:
+            self.buffer = bytearray(response.content)
+            self.buffer_offset = offset
+            return bytes(self.buffer[:length])
+        if response.status_code == 416:
+            # offset is past the end of the image
+            response.close()
+            return b""
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        self.response = response
+        self.buffer = bytearray()
+        self.buffer_offset = 0
+        return self.read(offset, length)
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+class LocalImage:
+    def __init__(self, filename: str):
+        self.file = open(filename, "rb")
+
+    def read(self, offset: int, length: int):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+
+def read_image_size(image):
+    # (width, height) from the header of a JPEG, PNG, GIF or WebP image, image.read(offset, length) returns its bytes
+    head = image.read(0, 32)
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        # IHDR is the first chunk
+        if len(head) < 24 or head[12:16] != b"IHDR":
+            raise ValueError("Invalid PNG header")
+        return struct.unpack(">II", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        if len(head) < 10:
+            raise ValueError("Invalid GIF header")
+        return struct.unpack("<HH", head[6:10])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        if len(head) < 30:
+            raise ValueError("Invalid WebP header")
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            # lossy: frame tag and start code, then 14 bit width and height
+            if head[23:26] != b"\x9d\x01\x2a":
+                raise ValueError("Invalid VP8 frame header")
+            width, height = struct.unpack("<HH", head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            # lossless: signature, then 14 bit width - 1 and height - 1
+            bits = int.from_bytes(head[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            # extended: 24 bit canvas width - 1 and height - 1
+            return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+        raise ValueError("Unsupported WebP chunk " + repr(chunk))
+    if head[:2] == b"\xff\xd8":
+        return read_jpeg_size(image)
+    raise ValueError("Unsupported image format")
+
+
+def read_jpeg_size(image):
+    # walk the marker segments up to the first start of frame, segments (e.g. EXIF thumbnails) are skipped without being read
+    offset = 2
+    while True:
+        marker = image.read(offset, 4)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Invalid JPEG marker at offset " + str(offset))
+        code = marker[1]
+        if code == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            # markers without a segment
+            offset += 2
+            continue
+        if code in (0xD9, 0xDA) or len(marker) < 4:
+            raise ValueError("No JPEG frame header found")
+        if code in JPEG_SOF_MARKERS:
+            frame = image.read(offset + 5, 4)
+            if len(frame) < 4:
+                raise ValueError("Truncated JPEG frame header")
+            height, width = struct.unpack(">HH", frame)
+            return width, height
+        offset += 2 + int.from_bytes(marker[2:4], "big")
+
+
+def get_image_size(source: str, session=None, chunk_size: int = 8192):
+    # (width, height) of an image from a URL or a local file, reading only its header
+    if source.startswith('http://') or source.startswith('https://'):
+        image = RemoteImage(source, session, chunk_size)
+        try:
+            return read_image_size(image)
+        finally:
+            image.close()
+    image = LocalImage(source)
+    try:
+        return read_image_size(image)
+    except ValueError:
+        # other formats supported by Pillow, which only reads their header as well
+        with Image.open(source) as img:
+            return img.size
+    finally:
+        image.close()
+
@@ -0,0 +1,180 @@
+import math
+import time
+import threading
+import contextlib
+
+
+class Metric:
+    """
+    Base of the in-process metrics: a family of values keyed by label values,
+    each guarded by the family's lock so that hot paths only pay for a dict
+    lookup and an addition.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def format_labels(self, labelvalues, extra=()):
+        labels = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in labels) + "}"
+
+    def samples(self):
+        # (suffix, label values, extra labels, value) of every series, used by render
+        with self.lock:
+            return [("", labelvalues, (), value) for labelvalues, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(
+                labelvalues, 0) + amount
+
+    def set_total(self, value: float, *labelvalues):
+        # mirror a total counted elsewhere (e.g. cache statistics), called by collectors at scrape time
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *labelvalues):
+        # values are [count per bucket..., sum], buckets are made cumulative when rendered
+        with self.lock:
+            values = self.values.get(labelvalues)
+            if values is None:
+                values = self.values[labelvalues] = [0] * \
+                    (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues):
+        # observe the duration of the with block in seconds
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *labelvalues)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(labelvalues, list(values))
+                     for labelvalues, values in self.values.items()]
+        for labelvalues, values in items:
+            count = 0
+            for bound, bucket in zip(self.buckets, values):
+                count += bucket
+                samples.append(("_bucket", labelvalues, (("le", "+Inf" if bound ==
+                               math.inf else repr(float(bound))),), count))
+            samples.append(("_sum", labelvalues, (), values[-1]))
+            samples.append(("_count", labelvalues, (), count))
+        return samples
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def register(metric: Metric):
+    with registry_lock:
+        registry[metric.name] = metric
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames=()):
+    return register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames=()):
+    return register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames=(), **kwargs):
+    return register(Histogram(name, documentation, labelnames, **kwargs))
+
+
+def add_collector(func):
+    # func is called on every scrape to refresh gauges and counters kept elsewhere (e.g. cache statistics)
+    with registry_lock:
+        collectors.append(func)
+
+
+def render():
+    # every registered metric in the Prometheus text exposition format (version 0.0.4)
+    with registry_lock:
+        funcs = list(collectors)
+        metrics = list(registry.values())
+    for func in funcs:
+        func()
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP {} {}".format(metric.name,
+                     metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for suffix, labelvalues, extra, value in metric.samples():
+            lines.append("{}{}{} {}".format(metric.name, suffix, metric.format_labels(
+                labelvalues, extra), format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+registry = {}
+collectors = []
+registry_lock = threading.Lock()
+
+# crawler
+ranking_page_seconds = histogram(
+    "pixiv_ranking_page_fetch_seconds", "Latency of ranking page requests to Pixiv (including rate limiter waits)", ("mode",))
+rate_limit_hits = counter(
+    "pixiv_rate_limit_hits_total", "Rate limited responses received from Pixiv", ("limiter",))
+download_bytes = counter(
+    "pixiv_download_bytes_total", "Bytes of images downloaded")
+download_seconds = histogram(
+    "pixiv_download_seconds", "Duration of image downloads", ("result",), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+insert_rows = counter(
+    "pixiv_db_insert_rows_total", "Rows written by insertManyDB", ("result",))
+insert_seconds = histogram(
+    "pixiv_db_insert_seconds", "Latency of insertManyDB batches")
+compressed_images = counter(
+    "pixiv_compressed_images_total", "Images processed by the compression task", ("status",))
+compressed_bytes = counter(
+    "pixiv_compressed_bytes_total", "Bytes of images before and after compression", ("stage",))
+
+# API
+query_seconds = histogram(
+    "pixiv_api_query_seconds", "Latency of randomDB and tagDB queries", ("query", "endpoint"))
+cache_requests = counter(
+    "pixiv_cache_requests_total", "Lookups of in-process caches", ("cache", "result"))
+cache_hit_ratio = gauge(
+    "pixiv_cache_hit_ratio", "Share of cache lookups that were hits since startup", ("cache",))
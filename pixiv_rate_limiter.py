@@ -0,0 +1,114 @@
+import time
+import random
+import logging
+import requests
+import threading
+import pixiv_metrics
+
+# init logger
+logger = logging.getLogger("uvicorn")
+
+
+class RateLimitException(Exception):
+    pass
+
+
+def is_rate_limited_error(e: Exception):
+    # HTTP 429 responses raised by raise_for_status (e.g. by image downloads)
+    return isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 429
+
+
+class RateLimiter:
+    """
+    Token bucket shared by several threads. The rate is halved whenever a
+    rate limit response is seen and climbs back towards requests_per_minute
+    after every successful call, while rate limited calls are retried after
+    an exponential backoff with jitter (shared by all threads).
+    """
+
+    def __init__(self, requests_per_minute: int = 60, burst: int = 1, backoff_base: float = 30, backoff_max: float = 600, increase_ratio: float = 0.05, min_ratio: float = 0.1, name: str = "default"):
+        # requests_per_minute of 0 disables the token bucket, backoff still applies
+        self.max_rate = requests_per_minute / 60
+        self.rate = self.max_rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.increase_ratio = increase_ratio
+        self.min_ratio = min_ratio
+        self.backoff_until = 0
+        self.backoff_count = 0
+        self.requests = 0
+        self.rate_limit_hits = 0
+        self.name = name
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available and no backoff is in progress
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.backoff_until - now
+                if wait <= 0:
+                    if self.max_rate == 0:
+                        self.requests += 1
+                        return
+                    self.tokens = min(self.capacity, self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        # additive increase of the rate after a successful call
+        with self.lock:
+            self.backoff_count = 0
+            if self.max_rate:
+                self.rate = min(self.max_rate, self.rate +
+                                self.max_rate * self.increase_ratio)
+
+    def rate_limited(self):
+        # multiplicative decrease of the rate and exponential backoff with jitter, returns the backoff in seconds
+        with self.lock:
+            self.backoff_count += 1
+            self.rate_limit_hits += 1
+            pixiv_metrics.rate_limit_hits.inc(self.name)
+            if self.max_rate:
+                self.rate = max(self.max_rate * self.min_ratio, self.rate / 2)
+            backoff = min(self.backoff_max, self.backoff_base *
+                          2 ** (self.backoff_count - 1))
+            backoff = random.uniform(backoff / 2, backoff)
+            self.backoff_until = max(
+                self.backoff_until, time.monotonic() + backoff)
+            return backoff
+
+    def call(self, func, *args, is_rate_limited=lambda result: False, is_rate_limited_exception=is_rate_limited_error, max_retries: int = 5, **kwargs):
+        # call func under the rate limit, retrying rate limited calls (a result flagged by is_rate_limited or an exception flagged by is_rate_limited_exception) up to max_retries times
+        retries = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+                limited = is_rate_limited(result)
+            except Exception as e:
+                if not is_rate_limited_exception(e):
+                    raise
+                limited = True
+            if not limited:
+                self.success()
+                return result
+            if retries >= max_retries:
+                raise RateLimitException
+            retries += 1
+            backoff = self.rate_limited()
+            logger.warning("Crawler rate limit encountered, retrying in " + str(round(backoff, 1)) +
+                           " seconds (" + str(retries) + "/" + str(max_retries) + " retries)")
+
+    def get_state(self):
+        with self.lock:
+            return {"rate_per_minute": round(self.rate * 60, 2), "max_rate_per_minute": round(self.max_rate * 60, 2), "backoff_seconds": round(max(0, self.backoff_until - time.monotonic()), 1), "requests": self.requests, "rate_limit_hits": self.rate_limit_hits}
@@ -0,0 +1,62 @@
+import re
+
+
+class TagMatcher:
+    """
+    Tag exclusion patterns (as in the excluding_tags option) compiled once:
+    "x" matches the whole tag, "x*" a prefix, "*x" a suffix and "*x*" a
+    substring, case insensitively. Exact patterns are looked up in a set,
+    prefixes and suffixes are checked by a single str.startswith/endswith
+    call over a tuple, and substrings by one compiled alternation, so that
+    matching a tag costs a few C-level calls whatever the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [pattern.strip().lower()
+                         for pattern in patterns if pattern.strip()]
+        self.exact = set()
+        prefixes = set()
+        suffixes = set()
+        substrings = set()
+        for pattern in self.patterns:
+            if pattern.startswith("*") and pattern.endswith("*"):
+                substrings.add(pattern.replace("*", ""))
+            elif pattern.startswith("*"):
+                suffixes.add(pattern.replace("*", ""))
+            elif pattern.endswith("*"):
+                prefixes.add(pattern.replace("*", ""))
+            else:
+                self.exact.add(pattern)
+        # an empty prefix/suffix/substring (e.g. "*") matches every tag
+        self.match_all = "" in prefixes or "" in suffixes or "" in substrings
+        self.prefixes = tuple(sorted(prefixes))
+        self.suffixes = tuple(sorted(suffixes))
+        self.substrings = re.compile("|".join(re.escape(substring)
+                                     for substring in sorted(substrings))).search if substrings else None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, tag: str):
+        # whether a tag name matches any pattern
+        if tag is None:
+            return False
+        tag = tag.lower()
+        return self.match_all or tag in self.exact or (bool(self.prefixes) and tag.startswith(self.prefixes)) or (bool(self.suffixes) and tag.endswith(self.suffixes)) or (self.substrings is not None and self.substrings(tag) is not None)
+
+    def match_tags(self, tags):
+        # whether any of the tags (objects or dicts with name and translated_name, as returned by Pixiv and tagDB) matches
+        if not self.patterns:
+            return False
+        for tag in tags:
+            if isinstance(tag, dict):
+                name, translated_name = tag.get("name"), tag.get("translated_name")
+            else:
+                name, translated_name = tag.name, tag.translated_name
+            if self.match(name) or self.match(translated_name):
+                return True
+        return False
+
+    def match_tag_ids(self, cursor):
+        # tag_ids of every stored tag matching a pattern, to exclude pictures at query time
+        return [tag_id for tag_id, name, translated_name in cursor.execute("SELECT tag_id, name, translated_name FROM tags") if self.match(name) or self.match(translated_name)]
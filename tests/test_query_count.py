@@ -0,0 +1,46 @@
+import os
+import sys
+import logging
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # the crawler and the API read config.ini and open their database in the working directory on import (as in benchmark.py)
+    folder = tmp_path_factory.mktemp("api")
+    working_directory = os.getcwd()
+    os.chdir(folder)
+    try:
+        with open("config.ini", "w", encoding="utf-8") as configfile:
+            configfile.write("[Crawler]\nupdate_interval = 0\nverify_interval = 0\n\n[API]\nimage_num_limit = 100\n")
+        import pixiv_crawler
+        import pixiv_crawler_api
+        from fastapi.testclient import TestClient
+        # the API is not started, so its config is read here instead of in the startup event (which also logs in to Pixiv)
+        pixiv_crawler_api.logger = logging.getLogger("uvicorn")
+        pixiv_crawler_api.read_config()
+        pixiv_crawler.insertManyDB([("{}_0".format(i), {"id": i, "author_id": i % 5, "author_name": "author", "title": "title", "page_no": 0, "page_count": 1, "orientation": i % 3, "r18": 0, "ai_type": 0,
+                                     "url": "https://i.pximg.net/{}.jpg".format(i), "local_filename": "", "tags": [{"name": "tag{}".format(j), "translated_name": None} for j in range(i % 4)]}) for i in range(50)])
+        yield TestClient(pixiv_crawler_api.app)
+    finally:
+        os.chdir(working_directory)
+
+
+def test_tags_of_a_result_set_take_one_query(client):
+    from pixiv_database import count_queries
+    # candidate picture_ids and tag names are cached by the first request
+    assert client.get("/api/v1", params={"num": 50}).json()["status"] == "success"
+    counts = {}
+    for num in [1, 10, 50]:
+        with count_queries() as counter:
+            response = client.get("/api/v1", params={"num": num})
+        assert len(response.json()["data"]) == num
+        # settings of the read connection opened by the worker thread of the request are not queries of the request
+        counts[num] = [sql for sql in counter["statements"] if not sql.startswith("PRAGMA")]
+    # the pictures picked by randomDB and the tags of all of them, whatever the number of results
+    for statements in counts.values():
+        assert len(statements) == 2
+        assert statements[0].startswith("SELECT * FROM pictures WHERE picture_id IN")
+        assert statements[1].startswith("SELECT picture_id, tag_id FROM picture_tags WHERE picture_id IN")